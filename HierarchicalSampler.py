@@ -1,208 +1,906 @@
 #!/usr/bin/env python3
 
 
-from Sampling import Sampler
+from Sampling import Sampler, PoolExhaustedError, get_rng_state, set_rng_state
 from sklearn.linear_model import LogisticRegression
-from sklearn.cluster import AgglomerativeClustering
-from scipy.sparse import vstack
-from collections import defaultdict
-from functools import lru_cache
-import itertools
+from TreeBuilders import TreeBuilder, AgglomerativeTreeBuilder, KNNGraph, Projection, MicroClustering, \
+    cluster_means, make_tree_builder, make_projection, make_micro_clustering
+from scipy.sparse import vstack, issparse, csr_matrix
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import random
+import copy
+import hashlib
+import os
+import struct
+import tempfile
+import zipfile
 import logging, sys
 
 from pprint import pprint
 
-class Node:
-    def __init__(self, node_id):
-        '''Node object constructor.
-
-        id -- integer representing id in clustering
-        left -- Node object representing left child in clustering tree
-        right -- Node object representing right child in clustering tree
-        parent -- Node object representing parent in clustering tree
-        is_leaf -- boolean representing whether node is leaf node or not
-        weight -- floating point number representing weight of subtree
-        subtree_leaves -- list of node objects representing the leaves in the subtree of this node
-        class_to_instances -- dictionary from class --> int tallying the number of instances seen for a class
-        num_revealed -- integer representing number of samples revealed that live under this node
+def _mmap_npz(path):
+    '''Return the arrays of an uncompressed .npz file as read-only memory maps.
+
+    np.load ignores mmap_mode for .npz archives, but members written by
+    np.savez are stored uncompressed, so each one can be mapped in place.
+    '''
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED
+            # The member data follows its local header and file name / extra fields
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')]
+            if np.prod(shape) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                         order='F' if fortran_order else 'C')
+    return arrays
+
+
+def _fingerprint(X):
+    '''Return a hash of the contents of a dense or sparse matrix.'''
+    digest = hashlib.sha1(repr((X.shape, str(X.dtype))).encode())
+    if issparse(X):
+        X = X.tocsr()
+        for part in (X.indptr, X.indices, X.data):
+            digest.update(np.ascontiguousarray(part).data)
+    else:
+        digest.update(np.ascontiguousarray(X).data)
+    return digest.hexdigest()
+
+
+def _params_key(obj):
+    '''Return a stable description of a tree engine setting for cache keys.'''
+    if isinstance(obj, (TreeBuilder, KNNGraph, Projection, MicroClustering)):
+        # Fitted attributes (trailing underscore) are not settings
+        params = [(name, value) for name, value in sorted(vars(obj).items()) if not name.endswith('_')]
+        return type(obj).__name__ + _params_key(params)
+    if hasattr(obj, '__dict__'):
+        # Other objects, e.g. executors, do not change the tree
+        return type(obj).__name__
+    if isinstance(obj, (list, tuple)):
+        return '(' + ','.join(_params_key(item) for item in obj) + ')'
+    if isinstance(obj, dict):
+        return _params_key(sorted(obj.items()))
+    if issparse(obj) or isinstance(obj, np.ndarray):
+        return _fingerprint(obj)
+    return repr(obj)
+
+
+def _append(owner, name, values):
+    '''Set the array owner.<name> to itself followed by values.
+
+    The array is kept as a prefix view of a buffer in owner._buffers that
+    doubles its capacity when full, so appending is amortized O(len(values)).
+    An array that is not a view of its buffer (e.g. a shared or replaced
+    array) is copied into a new buffer first and is never written to.
+    '''
+    current = getattr(owner, name)
+    buffer = owner._buffers.get(name)
+    n, m = current.shape[0], len(values)
+    if buffer is None or current.base is not buffer or n + m > buffer.shape[0]:
+        buffer = np.empty((max(2 * n, n + m, 16),) + current.shape[1:], dtype=current.dtype)
+        buffer[:n] = current
+        owner._buffers[name] = buffer
+    buffer[n:n + m] = values
+    setattr(owner, name, buffer[:n + m])
+
+
+class _CSRBuffers:
+    '''Growable data, indices and indptr arrays of a CSR matrix, see _append_rows.'''
+    def __init__(self, X):
+        nnz = X.indptr[-1]
+        self.data, self.indices, self.indptr = X.data[:nnz], X.indices[:nnz], X.indptr
+        self.matrix = X
+        self._buffers = {}
+
+
+def _append_rows(owner, name, X_new):
+    '''Set the dense or CSR matrix owner.<name> to itself with the rows of X_new
+    appended, in amortized O(size of X_new) like _append.'''
+    X = getattr(owner, name)
+    if not issparse(X):
+        _append(owner, name, X_new.toarray() if issparse(X_new) else X_new)
+        return
+    X_new = csr_matrix(X_new, dtype=X.dtype)
+    parts = owner._buffers.get(name)
+    if parts is None or parts.matrix is not X:
+        parts = owner._buffers[name] = _CSRBuffers(X.tocsr())
+    nnz = parts.indptr[-1]
+    _append(parts, 'data', X_new.data)
+    _append(parts, 'indices', X_new.indices)
+    _append(parts, 'indptr', X_new.indptr[1:] + nnz)
+    parts.matrix = csr_matrix((parts.data, parts.indices, parts.indptr),
+                              shape=(len(parts.indptr) - 1, X.shape[1]))
+    setattr(owner, name, parts.matrix)
+
+
+class _GrowingRows:
+    '''A CSR matrix that grows by appending rows, see _append_rows.'''
+    def __init__(self, X):
+        self.rows = X
+        self._buffers = {}
+
+
+def _node_centroids(tree, leaf_centers, leaf_weights):
+    '''Return the weighted mean of leaf_centers under every node of tree
+    (CSR if leaf_centers is sparse), one row per node.
+
+    The centroids are merged bottom-up one level at a time, with
+    c[v] = (w[l] c[l] + w[r] c[r]) / w[v] for the children l and r of v,
+    so only one row per node is ever built.
+    '''
+    weights = np.zeros(tree.num_nodes)
+    weights[:tree.num_leaves] = leaf_weights
+    if not issparse(leaf_centers):
+        centroids = np.empty((tree.num_nodes, leaf_centers.shape[1]))
+        centroids[:tree.num_leaves] = leaf_centers
+        for level in tree.levels[1:]:
+            left_ids, right_ids = tree.left[level], tree.right[level]
+            weights[level] = weights[left_ids] + weights[right_ids]
+            centroids[level] = (weights[left_ids, None] * centroids[left_ids]
+                                + weights[right_ids, None] * centroids[right_ids]) / weights[level, None]
+        return centroids
+
+    # Sparse rows are appended level by level, row_of maps node ids to rows
+    built = _GrowingRows(csr_matrix(leaf_centers, dtype=np.float64))
+    row_of = np.arange(tree.num_nodes)
+    for level in tree.levels[1:]:
+        left_ids, right_ids = tree.left[level], tree.right[level]
+        weights[level] = weights[left_ids] + weights[right_ids]
+        rows = built.rows
+        merged = rows[row_of[left_ids]].multiply((weights[left_ids] / weights[level])[:, None]) \
+            + rows[row_of[right_ids]].multiply((weights[right_ids] / weights[level])[:, None])
+        row_of[level] = np.arange(rows.shape[0], rows.shape[0] + len(level))
+        _append_rows(built, 'rows', merged)
+    return built.rows[row_of]
+
+
+def _row_dots(C, ids, X):
+    '''Return the dot product of row ids[i] of C (dense or CSR) with row i of
+    the dense matrix X, for every i.
+
+    For CSR this only touches the stored entries of the selected rows,
+    without building intermediate sparse matrices.
+    '''
+    if not issparse(C):
+        return np.einsum('ij,ij->i', C[ids], X)
+    starts = C.indptr[ids]
+    counts = C.indptr[ids + 1] - starts
+    rows = np.repeat(np.arange(len(ids)), counts)
+    entries = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.bincount(rows, C.data[entries] * X[rows, C.indices[entries]], minlength=len(ids))
+
+
+def _group_by_level(height):
+    '''Return the node ids grouped by height, lowest level first.'''
+    nodes = np.argsort(height, kind='stable')
+    bounds = np.cumsum(np.bincount(height))[:-1]
+    return np.split(nodes, bounds)
+
+
+class ClusterTree:
+    '''Array-backed binary cluster tree.
+
+    Node ids follow the layout of sklearn's children_ attribute: ids
+    0..num_leaves-1 are the leaves and node num_leaves+i is the cluster
+    merged in children[i]. Every array below is indexed by node id.
+    Each leaf holds one sample, or a block of samples in "coarse leaf" mode.
+
+    parent -- integer array of parent ids (-1 for the root)
+    left -- integer array of left child ids (-1 for leaves)
+    right -- integer array of right child ids (-1 for leaves)
+    size -- integer array with the number of samples living under each node
+    weight -- floating point array, size normalized by the total number of samples
+        (computed from size on access)
+    depth -- integer array with the distance of each node from the root
+    height -- integer array with the distance of each node from its deepest leaf
+    levels -- list of node id arrays grouped by height, leaves first
+    start, end -- integer arrays, the samples under each node occupy positions
+        [start, end) of the depth-first sample order
+
+    preorder -- node ids in depth-first preorder, visiting the child with more
+        nodes first, so every heavy path (chain of such children) is contiguous
+    pre_start, pre_end -- integer arrays, the subtree of each node occupies
+        positions [pre_start, pre_end) of preorder
+    chain_head -- integer array with the top node of each node's heavy path
+
+    leaf_of -- leaf id holding each sample id
+    order -- sample ids in depth-first (left to right) order
+    position -- inverse of order, the depth-first position of each sample id
+    '''
+    def __init__(self, children, num_leaves, leaf_of=None):
+        children = np.asarray(children, dtype=np.intp).reshape(-1, 2)
+        assert children.shape[0] == num_leaves - 1
+        if leaf_of is None:
+            leaf_of = np.arange(num_leaves)
+        self.leaf_of = np.asarray(leaf_of, dtype=np.intp)
+        self._buffers = {}  # growable arrays, see _append
+        self.num_leaves = num_leaves
+        self.num_samples = len(self.leaf_of)
+        self.num_nodes = 2 * num_leaves - 1
+        self.root = self.num_nodes - 1
+
+        self.left = np.full(self.num_nodes, -1, dtype=np.intp)
+        self.right = np.full(self.num_nodes, -1, dtype=np.intp)
+        self.parent = np.full(self.num_nodes, -1, dtype=np.intp)
+        internal = np.arange(num_leaves, self.num_nodes)
+        self.left[internal] = children[:, 0]
+        self.right[internal] = children[:, 1]
+        self.parent[children[:, 0]] = internal
+        self.parent[children[:, 1]] = internal
+        assert self.parent[self.root] == -1
+
+        # Group the nodes into levels by height (leaves are level 0), so every
+        # bottom-up pass is a short loop of vectorized steps over whole levels.
+        self.height = np.zeros(self.num_nodes, dtype=np.intp)
+        num_ready = np.zeros(self.num_nodes, dtype=np.intp)
+        frontier = np.arange(num_leaves)
+        while frontier[0] != self.root:
+            parents = self.parent[frontier]
+            np.add.at(num_ready, parents, 1)
+            parents = np.unique(parents)
+            frontier = parents[num_ready[parents] == 2]
+            self.height[frontier] = np.maximum(self.height[self.left[frontier]],
+                                               self.height[self.right[frontier]]) + 1
+        self.levels = _group_by_level(self.height)
+
+        self.size = np.zeros(self.num_nodes, dtype=np.int64)
+        self.size[:num_leaves] = np.bincount(self.leaf_of, minlength=num_leaves)
+        assert np.all(self.size[:num_leaves] > 0)
+        for level in self.levels[1:]:
+            self.size[level] = self.size[self.left[level]] + self.size[self.right[level]]
+        num_subtree_nodes = np.ones(self.num_nodes, dtype=np.intp)
+        for level in self.levels[1:]:
+            num_subtree_nodes[level] += num_subtree_nodes[self.left[level]] + num_subtree_nodes[self.right[level]]
+
+        # Top-down pass, one depth at a time. Laying the left subtree before the
+        # right one makes every subtree a contiguous range of the depth-first sample order.
+        # The node preorder instead visits the larger child first, so that any
+        # upward path crosses at most log2(num_nodes) heavy paths.
+        self.depth = np.zeros(self.num_nodes, dtype=np.intp)
+        self.start = np.zeros(self.num_nodes, dtype=np.intp)
+        self.pre_start = np.zeros(self.num_nodes, dtype=np.intp)
+        self.chain_head = np.full(self.num_nodes, self.root, dtype=np.intp)
+        frontier = np.array([self.root])
+        while len(frontier) > 0:
+            left_ids, right_ids = self.left[frontier], self.right[frontier]
+            self.depth[left_ids] = self.depth[right_ids] = self.depth[frontier] + 1
+            self.start[left_ids] = self.start[frontier]
+            self.start[right_ids] = self.start[frontier] + self.size[left_ids]
+            left_heavy = num_subtree_nodes[left_ids] >= num_subtree_nodes[right_ids]
+            heavy_ids = np.where(left_heavy, left_ids, right_ids)
+            light_ids = np.where(left_heavy, right_ids, left_ids)
+            self.pre_start[heavy_ids] = self.pre_start[frontier] + 1
+            self.pre_start[light_ids] = self.pre_start[frontier] + 1 + num_subtree_nodes[heavy_ids]
+            self.chain_head[heavy_ids] = self.chain_head[frontier]
+            self.chain_head[light_ids] = light_ids
+            frontier = np.concatenate((left_ids, right_ids))
+            frontier = frontier[self.left[frontier] >= 0]
+        self.end = self.start + self.size
+        self.pre_end = self.pre_start + num_subtree_nodes
+        self.preorder = np.empty(self.num_nodes, dtype=np.intp)
+        self.preorder[self.pre_start] = np.arange(self.num_nodes)
+        self.order = np.argsort(self.start[self.leaf_of], kind='stable')
+        self.position = np.empty(self.num_samples, dtype=np.intp)
+        self.position[self.order] = np.arange(self.num_samples)
+
+    # Arrays written by save() and restored by load()
+    ARRAYS = ('leaf_of', 'parent', 'left', 'right', 'size', 'depth', 'height',
+              'start', 'end', 'order', 'position', 'preorder', 'pre_start', 'pre_end', 'chain_head')
+
+    def save(self, path_or_file):
+        '''Save the tree as an uncompressed .npz file.'''
+        np.savez(path_or_file, **{name: getattr(self, name) for name in self.ARRAYS})
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''Load a tree written by save(), memory-mapping its arrays by default.'''
+        return cls.from_arrays(_mmap_npz(path) if mmap else dict(np.load(path)))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''Return the tree with the given ARRAYS (a dict of name --> array).'''
+        tree = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree.num_samples = len(tree.leaf_of)
+        tree.num_nodes = len(tree.parent)
+        tree.num_leaves = (tree.num_nodes + 1) // 2
+        tree.root = tree.num_nodes - 1
+        tree.levels = _group_by_level(tree.height)
+        tree._buffers = {}
+        return tree
+
+    @property
+    def weight(self):
+        return self.size / float(self.num_samples)
+
+    def copy(self):
+        '''Return a copy of the tree that owns its arrays.'''
+        tree = copy.copy(self)
+        for name in self.ARRAYS:
+            setattr(tree, name, np.array(getattr(self, name)))
+        tree._buffers = {}
+        return tree
+
+    def attach(self, leaf_paths):
+        '''Add one new sample to the leaf at the bottom of each path in leaf_paths
+        (upward paths from the leaves to the root), modifying this tree in place.
+
+        The new samples get the next sample ids and are counted in size, but
+        they have no depth-first position (position -1) until relayout().
         '''
-        self.id = node_id
-        self.left = None
-        self.right = None
-        self.parent = None
+        _append(self, 'leaf_of', [path[0] for path in leaf_paths])
+        _append(self, 'position', np.full(len(leaf_paths), -1, dtype=np.intp))
+        self.num_samples = len(self.leaf_of)
+        for path in leaf_paths:
+            self.size[path] += 1
+
+    def relayout(self, leaf_of=None):
+        '''Return a tree with the same nodes and a recomputed depth-first sample
+        order, which places the samples added by attach().'''
+        children = np.column_stack((self.left, self.right))[self.num_leaves:]
+        return ClusterTree(children, self.num_leaves, self.leaf_of if leaf_of is None else leaf_of)
+
+    def is_leaf(self, node_id):
+        return self.left[node_id] < 0
+
+    def is_ancestor(self, v_id, z_id):
+        '''Return if z_id is in the subtree of v_id (z_id itself included).'''
+        return self.pre_start[v_id] <= self.pre_start[z_id] < self.pre_end[v_id]
+
+    def upward_path(self, z_id, v_id):
+        '''Return the node ids from z up to v inclusive, as an integer array.
+
+        The path is cut into at most log2(num_nodes) pieces of heavy paths,
+        each of which is a reversed slice of the preorder.
+        '''
+        if not self.is_ancestor(v_id, z_id):
+            raise ValueError('node_id {} is not under node_id {}'.format(z_id, v_id))
+        pieces = []
+        while self.chain_head[z_id] != self.chain_head[v_id]:
+            head_id = self.chain_head[z_id]
+            pieces.append(self.preorder[self.pre_start[head_id]:self.pre_start[z_id] + 1][::-1])
+            z_id = self.parent[head_id]
+        pieces.append(self.preorder[self.pre_start[v_id]:self.pre_start[z_id] + 1][::-1])
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def subtree_samples(self, node_id):
+        '''Return the sample ids under node_id from left to right (a view).'''
+        return self.order[self.start[node_id]:self.end[node_id]]
+
 
-        self.is_leaf = True
-        self.weight = 0
-        self.subtree_leaves = []
 
-        self.class_to_instances = defaultdict(int)
-        self.num_revealed = 0
+class FenwickTree:
+    '''Binary indexed tree over a fixed number of non-negative values.
+
+    Supports point updates, prefix sums and locating the element that holds a
+    given prefix sum in O(log n), which is what weighted sampling needs.
+    '''
+    def __init__(self, values, dtype=np.int64):
+        self.values = np.array(values, dtype=dtype)
+        values = self.values
+        self.n = len(values)
+        # tree[i] (1-indexed) holds the sum of values[i - lowbit(i), i)
+        prefix = np.zeros(self.n + 1, dtype=dtype)
+        np.cumsum(values, out=prefix[1:])
+        i = np.arange(1, self.n + 1)
+        self.tree = np.zeros(self.n + 1, dtype=dtype)
+        self.tree[1:] = prefix[i] - prefix[i - (i & -i)]
+        self.top = 1 << (self.n.bit_length() - 1) if self.n else 0
+
+    def set(self, idx, value):
+        '''Set values[idx] to value.'''
+        self.add(idx, value - self.values[idx])
+
+    def add(self, idx, delta):
+        '''Add delta to values[idx].'''
+        self.values[idx] += delta
+        i = idx + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, idx):
+        '''Return the sum of values[0:idx].'''
+        total = 0
+        i = idx
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix_sum(self.n)
+
+    def find(self, u):
+        '''Return the index i with prefix_sum(i) <= u < prefix_sum(i+1).
+
+        u must lie in [0, total()).
+        '''
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] <= u:
+                pos = nxt
+                u -= self.tree[nxt]
+            step >>= 1
+        return pos
 
 
 
 class HierarchicalSampler(Sampler):
     '''Samples datapoints based on a hierarchical method as described in the paper.
     '''
-    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1):
-        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled)
+    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1, incremental=True,
+                 tree_builder=None, knn_graph=None, projection=None, micro_clusters=None,
+                 tree_cache=None, beta=2.0, seed=None, rebuild_threshold=0.5):
+        '''tree_builder -- TreeBuilder engine, or engine name in TreeBuilders.TREE_BUILDERS,
+        used to build the cluster tree. Defaults to sklearn's ward AgglomerativeClustering.
+
+        knn_graph -- TreeBuilders.KNNGraph. If given, the agglomerative clustering
+        only merges neighbors in this sparse k-nearest-neighbor graph of the pool.
+
+        projection -- TreeBuilders.Projection, or one of 'svd', 'random' and 'hash'.
+        If given, the tree is built on this low-dimensional float32 copy of the
+        data, while samples are still returned from the original features.
+
+        micro_clusters -- TreeBuilders.MicroClustering, or a number of micro-clusters.
+        If given ("coarse leaf" mode), the samples are first grouped into
+        micro-clusters and the tree is built over them, so each leaf holds a
+        block of samples and the tree grows with the number of micro-clusters.
+
+        tree_cache -- directory in which built trees are saved, keyed by a hash of
+        the data and of the settings above. Later runs on the same data and
+        settings memory-map the saved tree instead of clustering again.
+
+        beta, seed -- see reset().
+
+        rebuild_threshold -- add_unlabeled() starts reclustering the pool in a
+        background thread once the samples added since the tree was built
+        exceed this fraction of the pool. None never reclusters.
+        '''
+        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled, batch_size)
         # Hierarchical clustering portion
+        self.tree_builder = tree_builder
+        self.knn_graph = knn_graph
+        self.projection = projection
+        self.micro_clusters = micro_clusters
+        self.tree_cache = tree_cache
+        self.incremental = incremental
+        self.rebuild_threshold = rebuild_threshold
         self.X_merged = None
         self.y_merged = None
-        self.root = None
-        self.nodes = {}
-        self.num_leaves = 0
+        self.tree = None
+        self.leaf_centers = None  # tree-space rows of the leaves the tree was built on
+        self.centroids = None  # tree-space centroid of every node, see _descend
+        self.num_unclustered = 0  # samples attached to the tree since it was built
+        self._rebuild = None
+        self._owns_tree = False  # if the tree arrays can be modified in place
+        self._buffers = {}  # growable arrays, see _append
 
         self._construct_tree()
-        self._compute_weights()
+        self.reset(beta=beta, seed=seed)
+        print('Tuning phase complete. Ready to use sampler.')
+
+        return
+
+
+    def reset(self, labels=None, beta=None, seed=None):
+        '''Forget every sampled label and start over on the same tree.
+
+        labels -- labels of the training samples revealed in the tuning phase.
+        Defaults to the current y_train.
+
+        beta -- admissibility threshold of the pruning labels. Defaults to the current beta.
+
+        seed -- seed of the random draws. If None, numpy's global random state is used.
+
+        Modifies:
+        all label, pruning and sampling state; the tree is kept as is
+        '''
+        if labels is not None:
+            labels = np.asarray(labels)
+            if len(labels) != self.X_train.shape[0]:
+                raise ValueError('expected {} training labels, got {}'.format(self.X_train.shape[0], len(labels)))
+            self.y_train = labels
+            self.y_merged = np.concatenate((self.y_train, self.y_unlabeled))
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+        if beta is not None:
+            self.beta = beta
+
+        # Give the samples attached by add_unlabeled() their depth-first position
+        if np.any(self.tree.position < 0):
+            self.tree = self.tree.relayout()
+            self._owns_tree = True
+        # Revealed bitmap indexed by sample id
+        self.revealed = np.zeros(self.tree.num_samples, dtype=bool)
+        self.revealed[:self.X_train.shape[0]] = True
+        self._initialize_state()
+
+        return
+
+
+    def _initialize_state(self):
+        '''Set up the label, pruning and sampling state of self.tree from the
+        samples in self.revealed, which must all have a depth-first position.
+        '''
+        # Per-node statistics, indexed by (node_id, label index into self.labels)
+        self.labels, self.y_index = np.unique(self.y_merged, return_inverse=True)
+        self.counts = np.zeros((self.tree.num_nodes, len(self.labels)), dtype=np.int64)
+        self.num_revealed = np.zeros(self.tree.num_nodes, dtype=np.int64)
+
+        # Empirical probabilities and confidence bounds, same indexing as self.counts.
+        # With incremental=True only the rows on the updated path are recomputed.
+        self.p_vl = np.zeros(self.counts.shape)
+        self.delta = np.zeros(self.counts.shape)
+        self.p_vl_LB = np.zeros(self.counts.shape)
+        self.p_vl_UB = np.ones(self.counts.shape)
+
+        # Best pruning of every subtree: score s_v, majority label and whether
+        # the node is split into its children's prunings (expand) or kept whole.
+        self.score = np.ones(self.tree.num_nodes)
+        self.best_label = np.zeros(self.tree.num_nodes, dtype=np.intp)
+        self.expand = np.zeros(self.tree.num_nodes, dtype=bool)
 
         # Hierarchical sampling portion
-        self.pruning = {self.root: -1}  # node_id --> majority_label
-        self.labels = set(self.y_merged)
-        self.revealed = set()
-        self.admissible_set = set()
-        self.beta = 2.0
-
-        # "Tuning phase": exhaust all training data first
-        self.tuning_phase = True
-        for _ in range(X_train.shape[0]):
-            self.sample()
-        self.tuning_phase = False
-        print('Tuning phase complete. Ready to use sampler.')
+        # Fenwick tree over the depth-first sample order holding 1 for every
+        # sample that can still be drawn.
+        self.available = FenwickTree(~self.revealed[self.tree.order])
+        # Samples attached by add_unlabeled() have no depth-first position yet.
+        # The undrawn ones are listed per leaf and counted per node.
+        self.pending = {}  # leaf id --> list of sample ids
+        self.num_pending = np.zeros(self.tree.num_nodes, dtype=np.int64)
+        self.pruning = {}  # node_id --> majority label index
+        # Pruning nodes that still have leaves to draw hold their leaf count in
+        # here. Exhausted pruning nodes and every other node hold 0.
+        self.pruning_weights = FenwickTree(np.zeros(self.tree.num_nodes))
+        self._add_to_pruning(self.tree.root, -1)
+        self.admissible = np.zeros((self.tree.num_nodes, len(self.labels)), dtype=bool)  # A
+
+        # "Tuning phase": reveal all training data (and any other revealed samples) first
+        self._reveal_training_data()
 
         return
 
 
+    def fork(self, labels=None, beta=None, seed=None):
+        '''Return a fresh sampler over the same tree, reset with the given arguments.
+
+        The tree and the data are shared, not copied; only the label, pruning
+        and sampling state is new, so forks are cheap to make for repeated trials.
+        '''
+        sampler = copy.copy(self)
+        # Both samplers now share the tree and the growable arrays
+        self._owns_tree = sampler._owns_tree = False
+        sampler._buffers = {}
+        sampler.reset(labels=labels, beta=beta, seed=seed)
+        return sampler
+
+
+    # Per-node and per-sample arrays saved as they are by save_state()
+    STATE = ('revealed', 'counts', 'num_revealed', 'p_vl', 'delta', 'p_vl_LB', 'p_vl_UB',
+             'score', 'best_label', 'expand', 'admissible', 'num_pending')
+
+    def _get_state(self):
+        state = {name: getattr(self, name) for name in self.STATE}
+        state['beta'] = np.array(self.beta)
+        state['available'] = self.available.values
+        state['pruning_weights'] = self.pruning_weights.values
+        state['pruning_nodes'] = np.array(list(self.pruning.keys()), dtype=np.intp)
+        state['pruning_labels'] = np.array(list(self.pruning.values()), dtype=np.intp)
+        state['pending_leaves'] = np.array([leaf_id for leaf_id, z_ids in self.pending.items() for _ in z_ids],
+                                           dtype=np.intp)
+        state['pending_ids'] = np.array([z_id for z_ids in self.pending.values() for z_id in z_ids], dtype=np.intp)
+        state.update(get_rng_state(self.rng))
+        # The state only makes sense on the tree it was saved with, which may
+        # have been rebuilt since the sampler was constructed
+        state.update({'tree_' + name: getattr(self.tree, name) for name in ClusterTree.ARRAYS})
+        state['num_unclustered'] = np.array(self.num_unclustered)
+        return state
+
+    def _set_state(self, state):
+        '''Restore a saved state, together with the tree it was saved on. Samples
+        added with add_unlabeled() before saving must have been added to this
+        sampler again. A background rebuild still running is abandoned.'''
+        tree = ClusterTree.from_arrays({name: state['tree_' + name] for name in ClusterTree.ARRAYS})
+        if tree.num_samples != self.X_merged.shape[0]:
+            raise ValueError('saved state has {} samples, this sampler has {}'.format(
+                tree.num_samples, self.X_merged.shape[0]))
+        if self._rebuild is not None:
+            # It would replace the tree and reset the state restored here
+            self._rebuild.cancel()
+            self._rebuild = None
+        num_unclustered = int(state['num_unclustered'])
+        if not (num_unclustered == self.num_unclustered and np.array_equal(tree.parent, self.tree.parent)
+                and np.array_equal(tree.leaf_of, self.tree.leaf_of)):
+            # Recomputed from the rows the saved tree was built on
+            self.leaf_centers = self.centroids = None
+        self.tree, self._owns_tree, self.num_unclustered = tree, True, num_unclustered
+        for name in self.STATE:
+            setattr(self, name, state[name])
+        self.beta = float(state['beta'])
+        self.available = FenwickTree(state['available'])
+        self.pruning_weights = FenwickTree(state['pruning_weights'])
+        self.pruning = dict(zip(state['pruning_nodes'].tolist(), state['pruning_labels'].tolist()))
+        self.pending = {}
+        for leaf_id, z_id in zip(state['pending_leaves'].tolist(), state['pending_ids'].tolist()):
+            self.pending.setdefault(leaf_id, []).append(z_id)
+        set_rng_state(self.rng, state)
+
+    def _reveal_training_data(self):
+        '''Tuning phase: add the labels of all revealed samples in one pass.
+        After a reset these are the training samples.
+
+        The counts of every node are accumulated over the whole tree at once,
+        followed by a single admissibility and pruning update.
+
+        Modifies:
+        self.counts, self.num_revealed and the statistics of every node
+        self.admissible
+        self.pruning
+        '''
+        tree = self.tree
+        revealed_ids = np.flatnonzero(self.revealed)
+
+        # Samples of a subtree are contiguous in the depth-first order, so the
+        # counts of every node are a difference of two cumulative sums.
+        sample_counts = np.zeros((tree.num_samples + 1, len(self.labels)), dtype=np.int64)
+        np.add.at(sample_counts, (tree.position[revealed_ids] + 1, self.y_index[revealed_ids]), 1)
+        np.cumsum(sample_counts, axis=0, out=sample_counts)
+        self.counts[:] = sample_counts[tree.end] - sample_counts[tree.start]
+        self.num_revealed[:] = self.counts.sum(axis=1)
+
+        all_nodes = np.arange(tree.num_nodes)
+        self._update_statistics(all_nodes)
+        # Only labels that were seen under a node are checked, as in _update
+        admissible = self._admissible(all_nodes, np.arange(len(self.labels)))
+        self.admissible |= admissible & (self.counts > 0)
+        for level in tree.levels:
+            self._update_scores(level)
+
+        self._remove_from_pruning(tree.root)
+        for u_id, label in self._best_pruning(tree.root).items():
+            self._add_to_pruning(u_id, label)
+        return
+
+
     def _is_unlabeled(self, node_id):
         '''Return if node_id (corresponding to sample) is part
-        of the unlabeled set.
+        of the unlabeled set. Also accepts an array of node ids.
         '''
-        assert node_id < self.X_train.shape[0] + self.X_unlabeled.shape[0]
+        assert np.all(node_id < self.X_train.shape[0] + self.X_unlabeled.shape[0])
         return node_id >= self.X_train.shape[0] 
 
     def _construct_tree(self):
         '''Construct tree object from clusters.
 
         Modifies:
-        self.root
-        self.nodes
-        self.num_leaves
+        self.X_merged
+        self.y_merged
+        self.tree, self.leaf_centers and self._projection
         '''
         # Run clustering based on merged partition of data
         print('constructing tree')
 
-        # Remove for production purposes
-        #self.X_unlabeled = self.X_unlabeled[:150]
-        #self.y_unlabeled = self.y_unlabeled[:150]
-
-        self.X_merged = vstack([self.X_train, self.X_unlabeled]).toarray()
+        # Sparse inputs (e.g. TF-IDF) stay sparse, sample() returns CSR rows
+        if issparse(self.X_train) or issparse(self.X_unlabeled):
+            self.X_merged = vstack([self.X_train, self.X_unlabeled], format='csr')
+        else:
+            self.X_merged = np.vstack([self.X_train, self.X_unlabeled])
         self.y_merged = np.concatenate((self.y_train, self.y_unlabeled))
 
+        cache_path = None
+        if self.tree_cache is not None:
+            cache_path = os.path.join(self.tree_cache, 'tree_{}.npz'.format(self._tree_key()))
+            if os.path.exists(cache_path):
+                print('loading cached tree ' + cache_path)
+                self.tree = ClusterTree.load(cache_path)
+                self._projection = None if self.projection is None else copy.copy(make_projection(self.projection))
+                return
+
+        self.tree, self._projection, self.leaf_centers = self._build_tree(self.X_merged)
+        self._owns_tree = True
+
+        if cache_path is not None:
+            # Write to a temporary file first so concurrent runs never read a partial tree
+            os.makedirs(self.tree_cache, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=self.tree_cache, suffix='.npz', delete=False) as f:
+                self.tree.save(f)
+            os.replace(f.name, cache_path)
+
+    def _build_tree(self, X_merged):
+        '''Cluster the rows of X_merged into a new tree.
+
+        Return the tree, the fitted projection (or None) and the leaf centers,
+        the rows of the data the tree was built on that new samples are attached by.
+        Only reads the settings of the sampler, so it can run in a background thread.
+        '''
         # Binary tree structure
-        clustering = AgglomerativeClustering()
-        clustering.fit(self.X_merged)
-        self.num_leaves = clustering.n_leaves_
-        # INTERPRETATION: each leaf is a 1-to-1 mapping to a sample.
-        assert self.num_leaves == self.X_merged.shape[0]
-        ii = itertools.count(self.X_merged.shape[0])
-
-        # Convert dictionary representation of tree into linked list tree structure
-        def findNode(idx):
-            return self.nodes[idx] if idx in self.nodes else Node(idx)
-
-        #print(len(clustering.children_))
-        for c in clustering.children_:
-            left_id, right_id, node_id = c[0], c[1], next(ii)
-            left, right, node = findNode(left_id), findNode(right_id), findNode(node_id)
-            left.parent = node
-            right.parent = node
-            node.left = left
-            node.right = right
-            self.nodes[node_id] = node
-            self.nodes[left_id] = left
-            self.nodes[right_id] = right
-        #print(len(self.nodes))
-
-        # Mark root node and any leaf nodes
-        self.root = next(node_id for node_id in self.nodes if self.nodes[node_id].parent is None)
-        for node_id, node in self.nodes.items():
-            if node.left or node.right:
-                node.is_leaf = False
-
-        assert type(self.root) is int
-        #print(self.root)
-
-
-    def _compute_weights(self):
-        '''Update weights of all nodes in the tree.
-
-        _construct_tree must have been called beforehand.
-        This function should only be called once.
+        # Engines that need dense input densify a temporary copy themselves.
+        builder = make_tree_builder(self.tree_builder)
+        if self.knn_graph is not None:
+            if not isinstance(builder, AgglomerativeTreeBuilder):
+                raise ValueError('knn_graph can only constrain the agglomerative tree builder')
+            builder = AgglomerativeTreeBuilder(builder.linkage, self.knn_graph, **builder.kwargs)
+        X_tree = X_merged
+        projection = None
+        if self.projection is not None:
+            projection = copy.copy(make_projection(self.projection))
+            X_tree = projection.fit_transform(X_tree)
+
+        # INTERPRETATION: each leaf is a 1-to-1 mapping to a sample,
+        # or to a micro-cluster of samples in "coarse leaf" mode.
+        leaf_of = None
+        if self.micro_clusters is not None:
+            leaf_of = make_micro_clustering(self.micro_clusters).fit_predict(X_tree)
+            X_tree = cluster_means(X_tree, leaf_of)
+        children = builder.build(X_tree)
+        return ClusterTree(children, X_tree.shape[0], leaf_of), projection, X_tree
+
+    def _to_tree_space(self, X):
+        '''Return the rows of X as seen by the tree builder.'''
+        return X if self._projection is None else self._projection.transform(X)
+
+    def _compute_centroids(self):
+        '''Compute the node centroids of the samples the tree was built on.
 
         Modifies:
-        self.weight for all nodes in self.nodes
+        self.leaf_centers and the fit of self._projection, if the tree was loaded from the cache
+        self.centroids and self.centroid_norms
         '''
-        
-        # Helper function to process nodes in tree bottom-up
-        def reverse_topological_process():
-            visited = set()
-
-            def visit(node_id):
-                visited.add(node_id)
-                node = self.nodes[node_id]
-                if node.is_leaf:
-                    node.subtree_leaves.append(node)
-                else:
-                    if node.left and node.left.id not in visited:
-                        visit(node.left.id)
-                    if node.right and node.right.id not in visited:
-                        visit(node.right.id)
-                    node.subtree_leaves.extend(node.left.subtree_leaves)
-                    node.subtree_leaves.extend(node.right.subtree_leaves)
-                node.weight = len(node.subtree_leaves)
-                return
+        tree = self.tree
+        num_built = tree.num_samples - self.num_unclustered
+        leaf_weights = np.bincount(tree.leaf_of[:num_built], minlength=tree.num_leaves)
+        if self.leaf_centers is None:
+            # The tree was loaded from the cache, recompute the rows it was built on
+            # (and fit the projection to them, as when the tree was built)
+            X_tree = self.X_merged[:num_built]
+            if self._projection is not None:
+                X_tree = self._projection.fit_transform(X_tree)
+            self.leaf_centers = X_tree if self.micro_clusters is None else cluster_means(X_tree, tree.leaf_of[:num_built])
+        self.centroids = _node_centroids(tree, self.leaf_centers, leaf_weights)
+        squares = self.centroids.multiply(self.centroids) if issparse(self.centroids) else self.centroids ** 2
+        self.centroid_norms = np.asarray(squares.sum(axis=1)).ravel()
+
+    def _descend(self, X_tree):
+        '''Return the leaf reached by each row of X_tree when walking down
+        from the root to the child with the nearer centroid.
+
+        The rows are walked down together, in dense blocks of about a million values.
+        '''
+        tree = self.tree
+        leaf_ids = np.full(X_tree.shape[0], tree.root, dtype=np.intp)
+        block_size = max(1, 2 ** 20 // max(1, X_tree.shape[1]))
+        for block_start in range(0, X_tree.shape[0], block_size):
+            X_block = X_tree[block_start:block_start + block_size]
+            X_block = X_block.toarray() if issparse(X_block) else np.asarray(X_block)
+            block_ids = leaf_ids[block_start:block_start + block_size]
+            active = np.flatnonzero(tree.left[block_ids] >= 0)
+            while len(active) > 0:
+                node_ids = block_ids[active]
+                left_ids, right_ids = tree.left[node_ids], tree.right[node_ids]
+                child_ids = np.concatenate((left_ids, right_ids))
+                X_active = X_block[np.tile(active, 2)]
+                # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, the first term is the same for both children
+                dist = self.centroid_norms[child_ids] - 2 * _row_dots(self.centroids, child_ids, X_active)
+                left_dist, right_dist = dist[:len(active)], dist[len(active):]
+                block_ids[active] = np.where(right_dist < left_dist, right_ids, left_ids)
+                active = active[tree.left[block_ids[active]] >= 0]
+        return leaf_ids
+
+    def add_unlabeled(self, X_new, y_new):
+        '''Add new samples to the unlabeled pool without reclustering.
+
+        Each new sample is attached to a leaf (a sample, or a micro-cluster in
+        "coarse leaf" mode) by descending the tree towards the nearer child
+        centroid, after which only the nodes on the paths from those leaves to the
+        root are updated, so a sample costs O(depth) steps. The growing pool
+        arrays double their capacity when full. The pool is reclustered
+        in the background once rebuild_threshold is crossed. The labels in y_new
+        are only revealed when a sample is drawn, and must be known labels.
 
-            for node_id in self.nodes:
-                if node_id not in visited:
-                    visit(node_id)
+        Modifies:
+        self.X_unlabeled, self.y_unlabeled, self.X_merged, self.y_merged (grown in place)
+        self.tree (copied first if it is shared)
+        the pending samples, and the best pruning scores and pruning on the paths
+        '''
+        self._finish_rebuild()
+        y_new = np.asarray(y_new)
+        if X_new.shape[0] != len(y_new):
+            raise ValueError('X_new has {} rows but y_new has {} labels'.format(X_new.shape[0], len(y_new)))
+        y_index = np.searchsorted(self.labels, y_new)
+        if np.any(y_index >= len(self.labels)) or np.any(self.labels[np.minimum(y_index, len(self.labels) - 1)] != y_new):
+            raise ValueError('y_new contains labels that are not in the pool')
+        if len(y_new) == 0:
             return
-        
-        print('computing weight for all nodes in tree')
-
-        # First find all leaf nodes in subtree
-        # and set weight as number of leaf nodes that live in its subtree
-        reverse_topological_process()
 
-        # Then normalize by total number of leaves in tree
-        n = 1.0 * self.num_leaves
-        for node in self.nodes.values():
-            node.weight /= n
-            assert node.weight < n
+        if self.centroids is None:
+            # Also fits the projection of a cached tree, so it must come first
+            self._compute_centroids()
+        leaf_ids = self._descend(self._to_tree_space(X_new))
+
+        for name in ('X_unlabeled', 'X_merged'):
+            _append_rows(self, name, X_new)
+        _append(self, 'y_unlabeled', y_new)
+        _append(self, 'y_merged', y_new)
+        _append(self, 'y_index', y_index)
+        _append(self, 'revealed', np.zeros(len(y_new), dtype=bool))
+
+        if not self._owns_tree:
+            self.tree = self.tree.copy()
+            self._owns_tree = True
+        z_ids = np.arange(self.tree.num_samples, self.tree.num_samples + len(y_new))
+        paths = [self.tree.upward_path(leaf_id, self.tree.root) for leaf_id in leaf_ids]
+        self.tree.attach(paths)
+        self.num_unclustered += len(z_ids)
+        for z_id, leaf_id, path in zip(z_ids, leaf_ids, paths):
+            self.num_pending[path] += 1
+            self.pending.setdefault(leaf_id, []).append(z_id)
+
+        # Only the sizes on the paths changed, so only those scores, and the
+        # pruning nodes on them, need to be recomputed (bottom-up).
+        update_nodes = np.unique(np.concatenate(paths))
+        update_nodes = update_nodes[np.argsort(-self.tree.depth[update_nodes], kind='stable')]
+        for node_id in update_nodes:
+            self._update_score(node_id)
+        for v_id in update_nodes:
+            if v_id in self.pruning:
+                self._remove_from_pruning(v_id)
+                for u_id, label in self._best_pruning(v_id).items():
+                    self._add_to_pruning(u_id, label)
+
+        if self._rebuild is None and self.rebuild_threshold is not None \
+                and self.num_unclustered > self.rebuild_threshold * self.tree.num_samples:
+            print('reclustering {} samples in the background'.format(self.tree.num_samples))
+            executor = ThreadPoolExecutor(max_workers=1)
+            self._rebuild = executor.submit(self._build_tree, self.X_merged)
+            executor.shutdown(wait=False)
         return
 
+    def _finish_rebuild(self, wait=False):
+        '''Switch to the tree reclustered in the background once it is ready.
 
-    @lru_cache(maxsize=256)
-    def _get_upward_path(self, z_id, v_id):
-        '''Get list of node_ids from z to v inclusive in an upward path.
-
-        NOTE: z must be a descendant of v.
-        Used in the "Update empirical counts and probabilities" portion of the code.
+        Samples added while it was being built are attached to it first. The
+        pruning restarts from the labels revealed so far. If the rebuild failed,
+        the error is logged and the current tree is kept.
         '''
-        trail = [z_id]
-        cur = z_id
-        parent = self.nodes[cur].parent.id
-        while cur != v_id:
-            cur = parent
-            try: parent = self.nodes[cur].parent.id
-            except: pass
-            trail.append(cur)
-            if cur is None:
-                raise ValueError('broken parent in node_id {}'.format(cur)) 
-        return trail
+        if self._rebuild is None or not (wait or self._rebuild.done()):
+            return
+        rebuild, self._rebuild = self._rebuild, None
+        try:
+            tree, projection, leaf_centers = rebuild.result()
+        except Exception:
+            logging.exception('reclustering failed, keeping the current tree')
+            return
+        self._projection, self.leaf_centers = projection, leaf_centers
+        self.tree, self.num_unclustered = tree, 0
+        self._compute_centroids()
+        num_built = tree.num_samples
+        late_leaf_ids = self._descend(self._to_tree_space(self.X_merged[num_built:]))
+        self.tree = tree.relayout(np.concatenate((tree.leaf_of, late_leaf_ids)))
+        self._owns_tree = True
+        self.num_unclustered = len(late_leaf_ids)
+        print('switched to the reclustered tree')
+        self._initialize_state()
+        return
 
+    def _tree_key(self):
+        '''Return the cache key of the tree: a hash of X_merged and the tree settings.'''
+        settings = (ClusterTree.ARRAYS, self.tree_builder, self.knn_graph, self.projection, self.micro_clusters)
+        return hashlib.sha1((_fingerprint(self.X_merged) + _params_key(settings)).encode()).hexdigest()
 
-        
 
     def _select(self):
         '''select(P) procedure in paper.
@@ -215,11 +913,13 @@ class HierarchicalSampler(Sampler):
             
             (1) choose v in Pruning with probability proportional to w_v.
             This is similar to random sampling.'''
-            # Normalize weights
-            pruning = list(self.pruning.keys())
-            weights = [self.nodes[node_id].weight for node_id in pruning]
-            v = np.random.choice(pruning, size=None, replace=True, p=weights)
-            return v
+            # Leaf counts are integers, so the running total never drifts.
+            # Exhausted nodes hold no weight, which renormalizes over the rest.
+            total = self.pruning_weights.total()
+            if total == 0:
+                raise PoolExhaustedError('all samples in the pool have been revealed')
+            u = self.rng.randint(total)
+            return self.pruning_weights.find(u)
         
         return method_1()
 
@@ -227,199 +927,289 @@ class HierarchicalSampler(Sampler):
     def _pick_sample_id_from_node(self, node_id):
         '''Pick a random point (node id) z from subtree T_{node_id}.
        
-        Should only be called after all training samples have been "revealed".
+        All training samples are "revealed" in the tuning phase.
         Therefore, the id returned should only be an unlabled one.
         Return None if all samples under this node have been sampled.
         '''
         # Could use margin sampling to find a weighted random sample for better performance.
         # But since we're only given a few days to work on this final project, we're not doing this :D.
         # For now, follow the algorithm.
-        # Adjustment for tuning phase: always prefer training data first
-        sample_ids = []
-        for leaf in self.nodes[node_id].subtree_leaves: 
-            sample_id = leaf.id
-            if sample_id not in self.revealed:
-                if not self._is_unlabeled(sample_id):
-                    assert self.tuning_phase
-                    self.revealed.add(sample_id)
-                    return sample_id
-                sample_ids.append(sample_id)
-
-        # tuning phase: MUST use training (labeled) data.
-        # not tuning phase: need to retry other node.
-        if self.tuning_phase or len(sample_ids) == 0:
+        first = self.available.prefix_sum(self.tree.start[node_id])
+        num_placed = self.available.prefix_sum(self.tree.end[node_id]) - first
+        num_available = num_placed + self.num_pending[node_id]
+        if num_available == 0:
             return None
 
-        unlabeled_id = random.choice(sample_ids)
-        self.revealed.add(unlabeled_id)
-        return random.choice(sample_ids)
-
-
+        u = self.rng.randint(num_available)
+        if u < num_placed:
+            position = self.available.find(first + u)
+            sample_id = self.tree.order[position]
+            self.available.add(position, -1)
+        else:
+            sample_id = self._pick_pending(node_id)
+        assert self._is_unlabeled(sample_id)
+        self.revealed[sample_id] = True
+        return sample_id
+
+    def _pick_pending(self, node_id):
+        '''Remove and return a uniformly random pending sample under node_id.'''
+        tree = self.tree
+        while not tree.is_leaf(node_id):
+            left_id = tree.left[node_id]
+            u = self.rng.randint(self.num_pending[node_id])
+            node_id = left_id if u < self.num_pending[left_id] else tree.right[node_id]
+        pending = self.pending[node_id]
+        i = self.rng.randint(len(pending))
+        pending[i], pending[-1] = pending[-1], pending[i]
+        self.num_pending[tree.upward_path(node_id, tree.root)] -= 1
+        return pending.pop()
+
+
+
+    def _draw(self):
+        '''Select a pruning node v, reveal a point z under it and add its
+        label to the counts on the path from z to v.
+
+        Return z and the upward path from the leaf of z to v.
+        '''
+        # Only pruning nodes with leaves left to draw can be selected,
+        # so the pick always succeeds.
+        v_id = self._select()
+        z_id = self._pick_sample_id_from_node(v_id)
+        assert z_id is not None
+        self._refresh_pruning_weight(v_id)
+
+        print('z: '+str(z_id))
+        # Update empirical counts, starting from the leaf holding z
+        path = self.tree.upward_path(self.tree.leaf_of[z_id], v_id)
+        self.counts[path, self.y_index[z_id]] += 1
+        self.num_revealed[path] += 1
+        return z_id, path
 
     def sample(self):
         '''Return selected training sample in X_unlabeled and corresponding label.
+        The sample is a 1-row CSR matrix when the input data is sparse.
 
         In hierarchical sampling, this procedure should select the datapoint based
         on the rest of the unsampled data as well as the structure of the tree.
         '''
+        self._finish_rebuild()
+        z_id, path = self._draw()
+        self._update(path, [self.y_index[z_id]])
+        return self.X_merged[z_id], self.y_merged[z_id]
 
-        # Helper function to update empirical counts and probabilities
-        def update_counts(z_label, z_id, v_id):
-            for node_id in self._get_upward_path(z_id, v_id):
-                node = self.nodes[node_id]
-                node.class_to_instances[z_label] += 1
-                node.num_revealed += 1
-            return
+    def next_indices(self, k=None):
+        '''Return the indices into X_unlabeled of k samples.
+
+        All k points are drawn from the current pruning and the admissible set
+        and pruning are updated once for the whole batch.
+        '''
+        k = self.batch_size if k is None else k
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp)
+        self._finish_rebuild()
+        z_ids, paths = [], []
+        for _ in range(k):
+            try:
+                z_id, path = self._draw()
+            except PoolExhaustedError:
+                if not z_ids:
+                    raise
+                break
+            z_ids.append(z_id)
+            paths.append(path)
+
+        z_ids = np.array(z_ids)
+        # Children lie deeper than their parents, so deepest first is bottom-up
+        update_nodes = np.unique(np.concatenate(paths))
+        update_nodes = update_nodes[np.argsort(-self.tree.depth[update_nodes], kind='stable')]
+        self._update(update_nodes, np.unique(self.y_index[z_ids]))
+        return z_ids - self.X_train.shape[0]
+
+    def _update_statistics(self, node_ids):
+        '''Recompute the empirical label probabilities of node_ids.
+
+        node_ids -- array of node ids whose counts changed since the last call.
+
+        Modifies:
+        self.p_vl, self.delta, self.p_vl_LB and self.p_vl_UB rows of node_ids
+        '''
+        n_v = self.num_revealed[node_ids][:, None]
+        seen = n_v > 0
+        n_v = np.maximum(n_v, 1)
+        p_vl = self.counts[node_ids] / (1.0*n_v)
+        delta = np.where(seen, 1/n_v + np.sqrt(p_vl * (1-p_vl) / n_v), 0.0)
+
+        self.p_vl[node_ids] = p_vl
+        self.delta[node_ids] = delta
+        # Nodes with no observations get the trivial bounds [0, 1]
+        self.p_vl_LB[node_ids] = np.where(seen, np.maximum(p_vl - delta, 0.0), 0.0)
+        self.p_vl_UB[node_ids] = np.where(seen, np.minimum(p_vl + delta, 1.0), 1.0)
+        return
+
+
+    def _admissible(self, node_ids, labels):
+        '''Return the boolean matrix of admissible (node, label) pairs in node_ids x labels.
+
+        (v, l) is admissible when 1 - p_LB(v, l) < beta * min_{l' != l} (1 - p_UB(v, l')).
+        The minimum over the other labels is 1 minus the largest upper bound
+        among them, which is the top upper bound of the node unless l itself
+        holds it, in which case it is the second one.
+        '''
+        node_ids = np.asarray(node_ids)
+        labels = np.asarray(labels)
+        p_vl_UB = self.p_vl_UB[node_ids]
+        top = np.argmax(p_vl_UB, axis=1)
+        rows = np.arange(len(node_ids))
+        top_UB = p_vl_UB[rows, top]
+        if p_vl_UB.shape[1] > 1:
+            second_UB = np.partition(p_vl_UB, -2, axis=1)[:, -2]
+        else:
+            second_UB = np.full(len(node_ids), -np.inf)
+
+        max_other = np.where(labels[None, :] == top[:, None], second_UB[:, None], top_UB[:, None])
+        lb = self.p_vl_LB[np.ix_(node_ids, labels)]
+        return 1 - lb < self.beta * (1 - max_other)
 
-        v_id, z_id = -1, -1  # sentinel values
-        while True:
-            # Loop section begin: keep looping because node v may have 
-            # all its associated samples revealed already.
-            v_id = self._select()
-            z_id = self._pick_sample_id_from_node(v_id)
-
-            if z_id is None:
-                print("finding another node to draw sanmples from")
-                continue
-            # Loop section end.
-            # Valid z when reach here
-            print('z: '+str(z_id))
-            z_label = self.y_merged[z_id]
-            update_counts(z_label, z_id, v_id)
-            self._update(self._get_upward_path(z_id, v_id), [z_label])
-            break
-        # Return sample when actually using sampler
-        if not self.tuning_phase:
-            return self.X_merged[z_id], self.y_merged[z_id]
 
     def _update(self, update_nodes, update_labels):
         '''Update. 
 
-        update_nodes -- list of nodes to update the admissible set with.
-        This is typically the upward path of the datapoint just sampled.
+        update_nodes -- list of nodes to update the admissible set with, bottom-up.
+        This is typically the upward path of the datapoint just sampled,
+        or the union of the paths of a batch.
 
         update_labels -- list of labels to update the admissible set with.
         This is typically just a single label for the datapoint just sampled.
         '''
-        p_vl = {}  # (node_id, int label) --> float
-        for node_id, node in self.nodes.items():
-            for label in self.labels:
-                p_vl[(node_id,label)] = 0
-                if label in node.class_to_instances:
-                    class_revealed_count = node.class_to_instances[label]
-                    p_vl[(node_id,label)] = class_revealed_count / (1.0*node.num_revealed)
-
-        delta = {}
-        for vl in p_vl:
-            v_id, label = vl
-            delta[vl] = 0
-            n_v = self.nodes[v_id].num_revealed 
-            if n_v > 0:
-                delta[vl] = 1/n_v + (p_vl[vl] * (1-p_vl[vl]) / n_v)**0.5
-
-        # Math functions here
-        def p_LB(v_id, label):
-            # no observations
-            if len(self.nodes[v_id].class_to_instances) == 0:
-                return 0
-            vl = (v_id, label)
-            return max(p_vl[vl]-delta[vl] , 0.0)
-        def p_UB(v_id, label):
-            # no observations
-            if len(self.nodes[v_id].class_to_instances) == 0:
-                return 1
-            vl = (v_id, label)
-            return min(p_vl[vl]+delta[vl], 1.0)
-
-        p_vl_LB = {(node_id, label): p_LB(node_id, label) for (node_id, label) in p_vl}
-        p_vl_UB = {(node_id, label): p_UB(node_id, label) for (node_id, label) in p_vl}
-
-        # Update admissible set A
-        def is_admissible(v_id, label):
-            vl = (v_id, label)
-            lb = p_vl_LB[vl]
-            min_other = float('inf')
-            for lp in self.labels:
-                if lp != label:
-                    vlp = (v_id, lp)
-                    min_other = min(min_other, 1 - p_vl_UB[vlp])
-            #print('1 - '+str(lb)+' < 2 * '+str(min_other))
-            return 1 - lb < self.beta * min_other
+        # Only the counts on the upward path changed, so only those rows of
+        # the statistics need to be recomputed.
+        if self.incremental:
+            self._update_statistics(update_nodes)
+        else:
+            self._update_statistics(np.arange(self.tree.num_nodes))
+
+        # Update admissible set A, only with labels that were seen under a node
+        block = np.ix_(update_nodes, update_labels)
+        self.admissible[block] |= \
+            self._admissible(update_nodes, update_labels) & (self.counts[block] > 0)
+
+        # Recompute epsilon_tilda_vl and the best pruning score bottom-up.
+        # A score only depends on the node's subtree, so only the nodes on the
+        # updated path (listed bottom-up) can change.
+        if self.incremental:
+            refresh_nodes = update_nodes
+            for node_id in update_nodes:
+                self._update_score(node_id)
+        else:
+            refresh_nodes = list(self.pruning.keys())
+            for level in self.tree.levels:
+                self._update_scores(level)
+
+        # Replace the pruning nodes whose best pruning changed by their
+        # sub-pruning. Every other pruning node is already its own best pruning.
+        for v_id in refresh_nodes:
+            if v_id in self.pruning:
+                self._remove_from_pruning(v_id)
+                for u_id, label in self._best_pruning(v_id).items():
+                    self._add_to_pruning(u_id, label)
+        #pprint(self.pruning)
 
-        for node_id in update_nodes:
-            for label in update_labels:
-                if is_admissible(node_id, label):
-                    #print('node ' + str(node_id) + ' label '+str(label) + ' is admissible')
-                    self.admissible_set.add((node_id, label))
-
-
-        # Compute epsilon_tilda_vl and s_v values bottom-up
-        epsilon_tilda_vl = {}  # (node_id, int label) --> float
-        s_v = {}  # node_id --> [score, P' and L' represented as {v_id: label}]
-        # Helper function to process nodes in tree bottom-up
-        def bottom_up_compute():
-            visited = set()
-
-            def visit(node_id):
-                '''Mutates entries in epsilon_tilda_vl and s_v.'''
-                visited.add(node_id)
-
-                node = self.nodes[node_id]
-
-                if node.left and node.left.id not in visited:
-                    visit(node.left.id)
-                if node.right and node.right.id not in visited:
-                    visit(node.right.id)
-
-                # All children have been visited
-                has_admissible = False
-                for label in self.labels:
-                    vl = (node_id, label)
-                    if vl in self.admissible_set:
-                        has_admissible = True
-                        epsilon_tilda_vl[vl] = 1 - p_vl[vl]
-                    else:
-                        epsilon_tilda_vl[vl] = 1
-                best_label = min((l for l in self.labels), key=lambda l: epsilon_tilda_vl[(node_id,l)])
-                best_score = epsilon_tilda_vl[(node_id, best_label)]
-                s_v[node_id] = [best_score, {node_id: best_label}]
-                if has_admissible and not node.is_leaf:
-                    w_v = node.weight
-                    children_score, children_pruning = 0, {}
-                    
-                    if node.left:
-                        left_id = node.left.id
-                        left_score, left_pruning = s_v[left_id]
-                        #print('node.left: ' + str(node.left.weight / w_v * left_score))
-                        children_score += node.left.weight / w_v * left_score
-                        children_pruning.update(left_pruning)
-                    if node.right:
-                        right_id = node.right.id
-                        right_score, right_pruning = s_v[right_id]
-                        #print('node.right: ' + str(node.right.weight / w_v * right_score))
-                        children_score += node.right.weight / w_v * right_score
-                        children_pruning.update(right_pruning)
-                    
-                    if children_score < best_score:
-                        s_v[node_id] = [children_score, children_pruning]
-                return
+        return
 
-            for node_id in self.nodes:
-                if node_id not in visited:
-                    visit(node_id)
-            return
+    def _add_to_pruning(self, node_id, label):
+        self.pruning[node_id] = label
+        self._refresh_pruning_weight(node_id)
 
-        bottom_up_compute()
+    def _remove_from_pruning(self, node_id):
+        del self.pruning[node_id]
+        self.pruning_weights.set(node_id, 0)
 
-        original_pruning = list(self.pruning.keys())
-        for v_id in original_pruning:
-            score, PL_prime = s_v[v_id]
-            del self.pruning[v_id]
-            self.pruning.update(PL_prime)
-        #pprint(self.pruning)
+    def _num_available(self, node_id):
+        '''Return the number of leaves under node_id that can still be drawn.'''
+        return self.available.prefix_sum(self.tree.end[node_id]) \
+            - self.available.prefix_sum(self.tree.start[node_id]) + self.num_pending[node_id]
+
+    def _refresh_pruning_weight(self, node_id):
+        '''Give pruning node node_id its selection weight, or 0 once exhausted.'''
+        exhausted = self._num_available(node_id) == 0
+        self.pruning_weights.set(node_id, 0 if exhausted else self.tree.size[node_id])
+
+    def _update_score(self, node_id):
+        '''Recompute the best pruning score s_v of node_id from its own
+        statistics and the cached scores of its children.
 
+        Modifies:
+        self.score[node_id]
+        self.best_label[node_id]
+        self.expand[node_id]
+        '''
+        tree = self.tree
+        admissible = self.admissible[node_id]
+        has_admissible = admissible.any()
+        epsilon_tilda_vl = np.where(admissible, 1 - self.p_vl[node_id], 1.0)
+        best_label = np.argmin(epsilon_tilda_vl)
+        best_score = epsilon_tilda_vl[best_label]
+
+        self.best_label[node_id] = best_label
+        self.score[node_id] = best_score
+        self.expand[node_id] = False
+        if has_admissible and not tree.is_leaf(node_id):
+            w_v = tree.size[node_id]
+            left_id, right_id = tree.left[node_id], tree.right[node_id]
+            children_score = tree.size[left_id] / w_v * self.score[left_id] \
+                + tree.size[right_id] / w_v * self.score[right_id]
+            if children_score < best_score:
+                self.score[node_id] = children_score
+                self.expand[node_id] = True
         return
-        
+
+    def _update_scores(self, node_ids):
+        '''Vectorized _update_score over node_ids, none of which may be an
+        ancestor of another (e.g. one level of self.tree.levels).
+
+        Modifies:
+        self.score[node_ids]
+        self.best_label[node_ids]
+        self.expand[node_ids]
+        '''
+        tree = self.tree
+        admissible = self.admissible[node_ids]
+        epsilon_tilda_vl = np.where(admissible, 1 - self.p_vl[node_ids], 1.0)
+        best_label = np.argmin(epsilon_tilda_vl, axis=1)
+        best_score = epsilon_tilda_vl[np.arange(len(node_ids)), best_label]
+
+        self.best_label[node_ids] = best_label
+        self.score[node_ids] = best_score
+        self.expand[node_ids] = False
+        split = admissible.any(axis=1) & (tree.left[node_ids] >= 0)
+        v_ids, best_score = node_ids[split], best_score[split]
+        w_v = tree.size[v_ids]
+        left_ids, right_ids = tree.left[v_ids], tree.right[v_ids]
+        children_score = tree.size[left_ids] / w_v * self.score[left_ids] \
+            + tree.size[right_ids] / w_v * self.score[right_ids]
+        expand = children_score < best_score
+        self.score[v_ids[expand]] = children_score[expand]
+        self.expand[v_ids[expand]] = True
+        return
+
+    def _best_pruning(self, node_id):
+        '''Return the best pruning of T_{node_id} as {v_id: label index}.
+
+        The pruning is stored implicitly by the expand flags: it consists of
+        the first nodes below node_id that are not expanded.
+        '''
+        pruning = {}
+        stack = [node_id]
+        while stack:
+            cur = stack.pop()
+            if self.expand[cur]:
+                stack.append(self.tree.right[cur])
+                stack.append(self.tree.left[cur])
+            else:
+                pruning[cur] = self.best_label[cur]
+        return pruning
+
 
 if __name__ == '__main__':
     from sklearn.datasets import fetch_20newsgroups_vectorized
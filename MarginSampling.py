@@ -1,48 +1,155 @@
 #!/usr/bin/env python3
 
 
-from Sampling import Sampler
+from Sampling import Sampler, PoolExhaustedError
 from sklearn.linear_model import LogisticRegression
+from scipy.sparse import vstack, issparse
+from joblib import Parallel, delayed
 import numpy as np
 import random
 from pdb import set_trace
 import logging, sys
 
 
+def _chunk_margins(lr, X):
+    '''Return the margins of the rows of X, keeping only the top 2 posteriors of each row.'''
+    posteriors = lr.predict_proba(X)
+    # Margin is measured as follows for sample n:
+    # M_n = || Pr(c|x_n) - Pr(c'|x_n) ||
+    # Where c is the most likely class for x_n and c' is the second most likely
+    # class for x_n
+    if posteriors.shape[1] < 2:
+        return np.ones(posteriors.shape[0])
+    top2 = np.partition(posteriors, posteriors.shape[1] - 2, axis=1)[:, -2:]
+    return np.abs(top2[:, 1] - top2[:, 0])
+
+
 class MarginSampler(Sampler):
     '''Samples datapoints with the smallest margins.
     
     Based on Section 2.2 of this paper
     http://www.cs.columbia.edu/~prokofieva/CandidacyPapers/Chen_AL.pdf
+
+    refit_every -- if given (online mode), the posteriors are refit on the
+    training data plus every sample so far after each refit_every samples,
+    warm-started from the previous fit, and only the points that are still
+    unlabeled are rescored and reordered. By default the posteriors are fit once.
+
+    chunk_size -- number of rows whose posteriors are computed at a time.
+    Only the margin of each row is kept, so memory does not grow with the number of classes.
+
+    n_jobs -- number of joblib workers scoring chunks in parallel (-1 for all cores)
+
+    queue_size -- number of smallest-margin points ordered at a time. The queue is
+    refilled with argpartition when it runs out, instead of sorting the whole pool.
     '''
-    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1):
-        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled)
+    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1, refit_every=None,
+                 chunk_size=10000, n_jobs=None, queue_size=1024):
+        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled, batch_size)
         logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
         logging.disable(logging.DEBUG)  # Comment out to turn on logging
+        self.refit_every = refit_every
+        self.chunk_size = chunk_size
+        self.n_jobs = n_jobs
+        self.queue_size = queue_size
 
         # Fit logistic regression to compute posteriors of all samples
-        lr = LogisticRegression()
+        self.lr = LogisticRegression(warm_start=refit_every is not None)
         logging.debug("Fitting logistic regression to compute posteriors...")
-        lr.fit(X_train, y_train)
+        self.lr.fit(X_train, y_train)
         logging.debug("Finished fitting logistic regression")
-        self.posteriors = lr.predict_proba(X_unlabeled)
+        # Margins of the points in X_unlabeled, inf once a point is sampled
+        self.margins = self._margins(np.arange(X_unlabeled.shape[0]))
 
-        # Margin is measured as follows for sample n:
-        # M_n = || Pr(c|x_n) - Pr(c'|x_n) ||
-        # Where c is the most likely class for x_n and c' is the second most likely
-        # class for x_n
-        sorted_margins = np.sort(self.posteriors, axis=1) 
-        self.margins = np.abs(sorted_margins[:,0] - sorted_margins[:,1])
-
-        self.sample_indices = np.argsort(self.margins)
+        # Points in the order they were sampled, followed by the queue of the
+        # next smallest-margin points
+        self.sample_indices = np.empty(X_unlabeled.shape[0], dtype=np.intp)
         self.num_sampled = 0
+        self.num_queued = 0
+        self.num_since_refit = 0
+
+    def _margins(self, indices):
+        '''Return the margins of the points indices of X_unlabeled, scored in chunks.'''
+        chunks = [indices[i:i + self.chunk_size] for i in range(0, len(indices), self.chunk_size)]
+        margins = Parallel(n_jobs=self.n_jobs)(
+            delayed(_chunk_margins)(self.lr, self.X_unlabeled[chunk]) for chunk in chunks)
+        return np.concatenate(margins) if margins else np.zeros(0)
+
+    def _next(self, k):
+        '''Return the next k (or fewer) unsampled points with the smallest margins.'''
+        num_left = len(self.margins) - self.num_sampled
+        if num_left == 0:
+            raise PoolExhaustedError('all samples in the pool have been sampled')
+        k = min(k, num_left)
+        if self.num_queued < k:
+            # Refill the queue with the smallest margins among the unsampled points
+            q = min(max(k, self.queue_size), num_left)
+            queue = np.argpartition(self.margins, q - 1)[:q] if q < len(self.margins) \
+                else np.arange(len(self.margins))
+            queue = queue[np.argsort(self.margins[queue], kind='stable')]
+            self.sample_indices[self.num_sampled:self.num_sampled + q] = queue
+            self.num_queued = q
+        sample_indices = self.sample_indices[self.num_sampled:self.num_sampled + k].copy()
+        self.margins[sample_indices] = np.inf
+        self.num_sampled += k
+        self.num_queued -= k
+        self.num_since_refit += k
+        if self.refit_every is not None and self.num_since_refit >= self.refit_every \
+                and self.num_sampled < len(self.margins):
+            self._refit()
+        return sample_indices
+
+    def _refit(self):
+        '''Refit the posteriors on the training data and the samples so far,
+        then rescore the points that have not been sampled yet.
+
+        Modifies:
+        self.lr
+        self.margins of the remaining points
+        the queue, which is emptied
+        '''
+        sampled = self.sample_indices[:self.num_sampled]
+        if issparse(self.X_train):
+            X = vstack([self.X_train, self.X_unlabeled[sampled]], format='csr')
+        else:
+            X = np.vstack([self.X_train, self.X_unlabeled[sampled]])
+        y = np.concatenate((self.y_train, self.y_unlabeled[sampled]))
+        # Warm starting needs the same classes as the previous fit
+        if not np.array_equal(np.unique(y), self.lr.classes_):
+            self.lr = LogisticRegression(warm_start=True)
+        logging.debug("Refitting logistic regression on {} samples...".format(len(y)))
+        self.lr.fit(X, y)
+
+        remaining = np.flatnonzero(np.isfinite(self.margins))
+        self.margins[remaining] = self._margins(remaining)
+        self.num_queued = 0
+        self.num_since_refit = 0
 
     def sample(self):
         '''Return selected training sample in X_unlabeled and corresponding label.'''
-        sample_idx = self.sample_indices[self.num_sampled]
-        self.num_sampled += 1
+        sample_idx = self._next(1)[0]
         return self.X_unlabeled[sample_idx], self.y_unlabeled[sample_idx]
 
+    def next_indices(self, k=None):
+        '''Return the indices of the k next smallest-margin samples.'''
+        return self._next(self.batch_size if k is None else k)
+
+    def _get_state(self):
+        state = {'sample_indices': self.sample_indices, 'margins': self.margins,
+                 'num_sampled': np.array(self.num_sampled), 'num_queued': np.array(self.num_queued)}
+        if self.refit_every is not None:
+            # The next refit warm-starts from the current fit
+            state.update(num_since_refit=np.array(self.num_since_refit), classes=self.lr.classes_,
+                         coef=self.lr.coef_, intercept=self.lr.intercept_)
+        return state
+
+    def _set_state(self, state):
+        self.sample_indices, self.margins = state['sample_indices'], state['margins']
+        self.num_sampled, self.num_queued = int(state['num_sampled']), int(state['num_queued'])
+        if self.refit_every is not None:
+            self.num_since_refit = int(state['num_since_refit'])
+            self.lr.classes_, self.lr.coef_, self.lr.intercept_ = state['classes'], state['coef'], state['intercept']
+
 
 if __name__ == '__main__':
     from sklearn.datasets import fetch_20newsgroups_vectorized
@@ -46,32 +46,26 @@ def run_test(sampler_type, X_train, y_train, X_test, y_test):
     # Samplers
     sampler = None
     if sampler_type == 'rs':
-        sampler = RandomSampler(X_train, y_train, X_unlabeled, y_unlabeled)
+        sampler = RandomSampler(X_train, y_train, X_unlabeled, y_unlabeled, batch_size)
     elif sampler_type == 'ms':
-        sampler = MarginSampler(X_train, y_train, X_unlabeled, y_unlabeled)
+        sampler = MarginSampler(X_train, y_train, X_unlabeled, y_unlabeled, batch_size)
     elif sampler_type == 'hs':
-        sampler = HierarchicalSampler(X_train, y_train, X_unlabeled, y_unlabeled)
+        sampler = HierarchicalSampler(X_train, y_train, X_unlabeled, y_unlabeled, batch_size, tree_cache='tree_cache')
     else:
         raise ValueError
 
     print("Finish constructing sampler class "+sampler_type)
 
     errors = []
-    X_train, y_train = sampler.X_train, sampler.y_train
+    sampled_indices = []
     i = 0
     while i < max_unlabeled_size:
-        x_samples, y_samples = np.empty((batch_size, X_train.shape[1]),float), np.empty((batch_size,),int)
-        for b in range(batch_size):
-            x_sample, y_sample = sampler.sample()
-            # hack
-            if sampler_type != 'hs':
-                x_sample = x_sample.toarray()
-            x_samples[b] = x_sample
-            y_samples[b] = y_sample
-        X_train = vstack([X_train, x_samples])
-        y_train = np.append(y_train, y_samples)
+        # Samplers return indices into the shared pool, the rows are gathered at once
+        sampled_indices.extend(sampler.next_indices())
+        X_labeled = vstack([X_train, X_unlabeled[sampled_indices]])
+        y_labeled = np.append(y_train, y_unlabeled[sampled_indices])
         model = LogisticRegression(multi_class="multinomial", solver="lbfgs", max_iter=200)
-        model.fit(X_train, y_train)
+        model.fit(X_labeled, y_labeled)
         #y_pred = model.predict(X_test)
         error = 1 - model.score(X_test, y_test)
         print(sampler_type+' number of labels: '+str(training_size+i)+ ' error='+str(error))
@@ -75,10 +75,11 @@ if __name__ == '__main__':
     max_unlabeled_size = 750#400
     lambda_value = 0#10**(-4)#This needs to be tuned
     num_training_data = 1200
+    shuffle_seed = None  # None draws a new split every run, an int fixes it (and lets the tree cache hit)
 
     #Sports Data
     data = pd.read_csv('phishingData.csv')
-    data = data.sample(frac=1)
+    data = data.sample(frac=1, random_state=shuffle_seed)
     data = data.values
     x_data = data[:,:-1]
     y_data = data[:,-1]
@@ -91,33 +92,27 @@ if __name__ == '__main__':
 
     rs = RandomSampler(X_train, y_train, X_unlabeled, y_unlabeled)
     ms = MarginSampler(X_train, y_train, X_unlabeled, y_unlabeled)
-    hs = HierarchicalSampler(X_train, y_train, X_unlabeled, y_unlabeled)
+    hs = HierarchicalSampler(X_train, y_train, X_unlabeled, y_unlabeled, tree_cache='tree_cache')
 
-    x_train_random = X_train
-    y_train_random = y_train
-    x_train_margin = X_train
-    y_train_margin = y_train
-    x_train_Hierarchical = X_train
-    y_train_Hierarchical = y_train
+    random_indices, margin_indices, Hierarchical_indices = [], [], []
 
     print('Successfully loaded the Sports dataset into train and test set.')
 
     for num_samples in range(max_unlabeled_size):
         #Add data, random
-        x_sample, y_sample = rs.sample()
-        x_sample = np.array([x_sample])
-        x_train_random = vstack([x_train_random, x_sample]).toarray()
-        y_train_random = np.append(y_train_random, y_sample)
+        random_indices.extend(rs.next_indices(1))
         #Add data, margin
-        x_sample, y_sample = ms.sample()
-        x_sample = np.array([x_sample])
-        x_train_margin = vstack([x_train_margin, x_sample]).toarray()
-        y_train_margin = np.append(y_train_margin, y_sample)
+        margin_indices.extend(ms.next_indices(1))
         #Add data, Hierarchical
-        x_sample, y_sample = hs.sample()
-        x_sample = np.array([x_sample])
-        x_train_Hierarchical = vstack([x_train_Hierarchical, x_sample]).toarray()
-        y_train_Hierarchical = np.append(y_train_Hierarchical, y_sample)
+        Hierarchical_indices.extend(hs.next_indices(1))
+
+    # Gather the sampled rows of each strategy at once instead of row by row
+    x_train_random = vstack([X_train, X_unlabeled[random_indices]]).toarray()
+    y_train_random = np.append(y_train, y_unlabeled[random_indices])
+    x_train_margin = vstack([X_train, X_unlabeled[margin_indices]]).toarray()
+    y_train_margin = np.append(y_train, y_unlabeled[margin_indices])
+    x_train_Hierarchical = vstack([X_train, X_unlabeled[Hierarchical_indices]]).toarray()
+    y_train_Hierarchical = np.append(y_train, y_unlabeled[Hierarchical_indices])
 
     for i in range(-8,9):
         lambda_value = 10**(i)
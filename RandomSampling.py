@@ -1,22 +1,179 @@
 #!/usr/bin/env python3
 
 
-from Sampling import Sampler
+from Sampling import Sampler, PoolExhaustedError
+from scipy.sparse import vstack, issparse, csr_matrix
 import numpy as np
 
 
 class RandomSampler(Sampler):
-    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1):
-        import random
-        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled)
-        self.sampled_indices = list(range(X_unlabeled.shape[0]))
-        random.shuffle(self.sampled_indices)
+    '''Samples datapoints uniformly at random without replacement.
+
+    seed -- seed (or numpy Generator) of the random order. None draws a fresh order.
+    '''
+    def __init__(self, X_train, y_train, X_unlabeled, y_unlabeled, batch_size=1, seed=None):
+        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled, batch_size)
+        self.rng = np.random.default_rng(seed)
+        # Samples are taken from the end of the permutation
+        self.sampled_indices = self.rng.permutation(X_unlabeled.shape[0])
+        self.num_left = len(self.sampled_indices)
 
     def sample(self):
         '''Return selected training sample in X_unlabeled and corresponding label.'''
-        sample_idx = self.sampled_indices.pop()
+        if self.num_left == 0:
+            raise PoolExhaustedError('all samples in the pool have been sampled')
+        self.num_left -= 1
+        sample_idx = self.sampled_indices[self.num_left]
         return self.X_unlabeled[sample_idx], self.y_unlabeled[sample_idx]
 
+    def next_indices(self, k=None):
+        '''Return the indices of the next k samples in X_unlabeled.'''
+        k = self.batch_size if k is None else k
+        if self.num_left == 0:
+            raise PoolExhaustedError('all samples in the pool have been sampled')
+        # Same order as k calls to sample()
+        first = max(self.num_left - k, 0)
+        sample_indices = self.sampled_indices[first:self.num_left][::-1]
+        self.num_left = first
+        return sample_indices
+
+    def _get_state(self):
+        return {'sampled_indices': self.sampled_indices, 'num_left': np.array(self.num_left)}
+
+    def _set_state(self, state):
+        self.sampled_indices = state['sampled_indices']
+        self.num_left = int(state['num_left'])
+
+
+def _stack(blocks):
+    return vstack(blocks, format='csr') if issparse(blocks[0]) else np.vstack(blocks)
+
+
+class Reservoir:
+    '''Uniform random sample of at most capacity rows of a stream of chunks.
+
+    Rows are kept in the chunks they arrived in, and compacted into one block
+    when the kept blocks grow to twice the capacity, so memory stays O(capacity).
+    '''
+    def __init__(self, capacity, rng):
+        self.capacity = capacity
+        self.rng = rng
+        self.num_seen = 0
+        self.blocks = []  # (X, y) rows kept from each chunk
+        self.slot_block = np.zeros(capacity, dtype=np.intp)
+        self.slot_row = np.zeros(capacity, dtype=np.intp)
+
+    def add(self, X, y):
+        '''Offer the rows of X (with labels y) to the reservoir (Algorithm R).'''
+        m = X.shape[0]
+        # Row i of the chunk is the (num_seen + i + 1)-th row of the stream, and
+        # replaces a uniform slot in [0, num_seen + i] if that slot is in the reservoir
+        slots = self.rng.integers(0, self.num_seen + np.arange(1, m + 1))
+        num_filling = min(max(self.capacity - self.num_seen, 0), m)
+        slots[:num_filling] = self.num_seen + np.arange(num_filling)
+        self.num_seen += m
+        rows = np.flatnonzero(slots < self.capacity)
+        # A later row replaces an earlier one in the same slot
+        slots, last = np.unique(slots[rows][::-1], return_index=True)
+        rows = rows[::-1][last]
+        if len(rows) == 0:
+            return
+        self.blocks.append((X[rows], y[rows]))
+        self.slot_block[slots] = len(self.blocks) - 1
+        self.slot_row[slots] = np.arange(len(rows))
+        if sum(block[0].shape[0] for block in self.blocks) > 2 * self.capacity:
+            self.blocks = [self.items()]
+            self.slot_row[:self.size()] = np.arange(self.size())
+            self.slot_block[:] = 0
+
+    def size(self):
+        return min(self.num_seen, self.capacity)
+
+    def items(self):
+        '''Return the rows and labels in the reservoir, in slot order.'''
+        n = self.size()
+        slot_block, slot_row = self.slot_block[:n], self.slot_row[:n]
+        used = np.unique(slot_block)
+        order = np.concatenate([np.flatnonzero(slot_block == b) for b in used])
+        X = _stack([self.blocks[b][0][slot_row[slot_block == b]] for b in used])
+        y = np.concatenate([self.blocks[b][1][slot_row[slot_block == b]] for b in used])
+        inverse = np.empty(n, dtype=np.intp)
+        inverse[order] = np.arange(n)
+        return X[inverse], y[inverse]
+
+
+class StreamingRandomSampler(RandomSampler):
+    '''Random sampling from a stream of unlabeled chunks too large to hold in memory.
+
+    The stream is read once with reservoir sampling, keeping a uniform random
+    sample of num_samples rows, which are then sampled in random order like
+    RandomSampler. Indices refer to the rows kept in X_unlabeled.
+
+    chunks -- iterable of (X_chunk, y_chunk) pairs, X_chunk dense or sparse
+    num_samples -- the most samples that will be drawn, i.e. the reservoir size
+    group_key -- optional function of (X_chunk, y_chunk) returning the group of
+    every row (e.g. lambda X, y: y). If given, sampling is stratified: the rows
+    kept from each group are proportional to its share of the stream. One
+    reservoir of num_samples rows is kept per group.
+    seed -- seed (or numpy Generator) of the reservoirs and of the random order
+
+    save_state also saves the kept rows, and load_state restores them in
+    place of the rows read from the stream.
+    '''
+    def __init__(self, X_train, y_train, chunks, num_samples, batch_size=1, group_key=None, seed=None):
+        rng = np.random.default_rng(seed)
+        reservoirs = {}  # group --> Reservoir
+        for X_chunk, y_chunk in chunks:
+            y_chunk = np.asarray(y_chunk)
+            if issparse(X_chunk):
+                X_chunk = X_chunk.tocsr()
+            if group_key is None:
+                reservoirs.setdefault(None, Reservoir(num_samples, rng)).add(X_chunk, y_chunk)
+                continue
+            groups = np.asarray(group_key(X_chunk, y_chunk))
+            for group in np.unique(groups):
+                rows = np.flatnonzero(groups == group)
+                reservoirs.setdefault(group, Reservoir(num_samples, rng)).add(X_chunk[rows], y_chunk[rows])
+        if not reservoirs:
+            raise ValueError('the stream of unlabeled chunks is empty')
+
+        # Largest remainder allocation of num_samples over the groups
+        reservoirs = list(reservoirs.values())
+        num_seen = np.array([r.num_seen for r in reservoirs])
+        total = min(num_samples, num_seen.sum())
+        quotas = total * num_seen / num_seen.sum()
+        counts = np.floor(quotas).astype(np.intp)
+        counts[np.argsort(counts - quotas, kind='stable')[:total - counts.sum()]] += 1
+
+        blocks = []
+        for reservoir, count in zip(reservoirs, counts):
+            X_group, y_group = reservoir.items()
+            # The reservoir is a uniform sample, so any count of its rows is one too
+            rows = rng.permutation(X_group.shape[0])[:count]
+            blocks.append((X_group[rows], y_group[rows]))
+        X_unlabeled = _stack([block[0] for block in blocks])
+        y_unlabeled = np.concatenate([block[1] for block in blocks])
+        super().__init__(X_train, y_train, X_unlabeled, y_unlabeled, batch_size, rng)
+
+    def _get_state(self):
+        # The kept rows depend on the stream and the seed, so they are saved too
+        state = super()._get_state()
+        state['y_unlabeled'] = self.y_unlabeled
+        if issparse(self.X_unlabeled):
+            X = self.X_unlabeled.tocsr()
+            state.update(X_data=X.data, X_indices=X.indices, X_indptr=X.indptr, X_shape=np.array(X.shape))
+        else:
+            state['X_unlabeled'] = self.X_unlabeled
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        self.y_unlabeled = state['y_unlabeled']
+        if 'X_data' in state:
+            self.X_unlabeled = csr_matrix((state['X_data'], state['X_indices'], state['X_indptr']),
+                                          shape=tuple(state['X_shape']))
+        else:
+            self.X_unlabeled = state['X_unlabeled']
 
 
 if __name__ == '__main__':
@@ -4,6 +4,19 @@
 How to use: add "from Sampling import Sampler" into your inherited sampling class.
 '''
 
+import numpy as np
+import os
+import tempfile
+
+
+class PoolExhaustedError(IndexError):
+    '''
+    Raised by a sampler when every datapoint in its unlabeled pool
+    has already been sampled.
+    '''
+    pass
+
+
 class Sampler:
     '''
     This is the base class for which the 3 different sampling classes
@@ -19,3 +32,71 @@ class Sampler:
     def sample(self):
         pass
 
+    def next_indices(self, k=None):
+        '''
+        Return the indices into X_unlabeled of the next k samples (batch_size
+        by default), without copying any rows. Fewer than k are returned once
+        the pool runs out. Callers gather the rows from sampler.X_unlabeled,
+        e.g. sampler.X_unlabeled[indices], not from the matrix they passed in:
+        HierarchicalSampler.add_unlabeled replaces it with a larger one, and the
+        rows already in it keep their indices.
+        '''
+        pass
+
+    def sample_batch(self, k=None):
+        '''
+        Return the indices into X_unlabeled, the rows and the labels of the
+        next k samples (batch_size by default) as one matrix slice.
+        Fewer than k are returned once the pool runs out.
+        '''
+        indices = self.next_indices(k)
+        return indices, self.X_unlabeled[indices], self.y_unlabeled[indices]
+
+    def _get_state(self):
+        '''
+        Return the sampling state as a dict of numpy arrays.
+        '''
+        return {}
+
+    def _set_state(self, state):
+        '''
+        Restore the sampling state returned by _get_state.
+        '''
+        pass
+
+    def save_state(self, path):
+        '''
+        Save the sampling state to path as an uncompressed .npz file of flat arrays.
+        The file is written next to path and then renamed, so a run killed
+        while saving keeps its previous checkpoint.
+        '''
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+            np.savez(f, **self._get_state())
+        os.replace(f.name, path)
+
+    def load_state(self, path):
+        '''
+        Restore the sampling state saved by save_state, so sampling resumes
+        where it stopped. The sampler must have been constructed on the same data.
+        '''
+        with np.load(path) as f:
+            self._set_state({name: f[name] for name in f.files})
+
+
+def get_rng_state(rng):
+    '''
+    Return the state of a numpy RandomState (or of the np.random module) as arrays.
+    '''
+    _, keys, pos, has_gauss, cached_gaussian = rng.get_state()
+    return {'rng_keys': keys, 'rng_pos': np.array(pos), 'rng_has_gauss': np.array(has_gauss),
+            'rng_cached_gaussian': np.array(cached_gaussian)}
+
+
+def set_rng_state(rng, state):
+    '''
+    Restore the state returned by get_rng_state.
+    '''
+    rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']), int(state['rng_has_gauss']),
+                   float(state['rng_cached_gaussian'])))
+
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+
+'''
+Tree-construction engines for HierarchicalSampler.
+
+Every engine is a TreeBuilder whose build(X) method returns the merges of a
+binary hierarchy over the rows of X in the layout of sklearn's
+AgglomerativeClustering.children_: an (n-1) x 2 integer array where ids
+0..n-1 are the samples and row i creates node n+i from two earlier nodes.
+
+How to use: pass an engine (or its name, see TREE_BUILDERS) as the
+tree_builder argument of HierarchicalSampler.
+'''
+
+from sklearn.cluster import AgglomerativeClustering, MiniBatchKMeans, Birch
+from sklearn.neighbors import kneighbors_graph
+from sklearn.decomposition import TruncatedSVD
+from sklearn.random_projection import SparseRandomProjection
+from sklearn.utils import murmurhash3_32
+from scipy.sparse import issparse, csr_matrix
+from joblib import Parallel, delayed
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def _row_norms_squared(X):
+    '''Return the squared euclidean norm of every row of a dense or sparse X.'''
+    if issparse(X):
+        return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+    return np.einsum('ij,ij->i', X, X)
+
+
+def _to_dense(X):
+    return X.toarray() if issparse(X) else np.asarray(X)
+
+
+class TreeBuilder:
+    '''
+    Base class of the tree-construction engines.
+    '''
+    def build(self, X):
+        '''Return the children_ array of a binary hierarchy over the rows of X.'''
+        pass
+
+
+def _rp_tree_neighbors(X, sq, n_neighbors, leaf_size, seed):
+    '''Return candidate (rows, cols, squared distances) neighbor pairs from
+    the leaves of one random projection tree over the rows of X.'''
+    rng = np.random.RandomState(seed)
+    rows, cols, dists = [], [], []
+    stack = [np.arange(X.shape[0])]
+    while stack:
+        idx = stack.pop()
+        if len(idx) <= leaf_size:
+            # Brute force within the leaf
+            k = min(n_neighbors, len(idx) - 1)
+            if k == 0:
+                continue
+            d = sq[idx][:, None] + sq[idx][None, :] - 2.0 * _to_dense(X[idx] @ X[idx].T)
+            np.fill_diagonal(d, np.inf)
+            nn = np.argpartition(d, k - 1, axis=1)[:, :k]
+            rows.append(np.repeat(idx, k))
+            cols.append(idx[nn].ravel())
+            dists.append(np.take_along_axis(d, nn, axis=1).ravel())
+            continue
+        # Split at the median projection onto the direction between two random rows
+        i, j = rng.choice(idx, 2, replace=False)
+        direction = _to_dense(X[i] - X[j]).ravel()
+        projection = np.asarray(X[idx] @ direction).ravel()
+        order = np.argsort(projection, kind='stable')
+        half = len(idx) // 2
+        stack.extend([idx[order[:half]], idx[order[half:]]])
+    if not rows:
+        return np.empty(0, np.intp), np.empty(0, np.intp), np.empty(0)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(dists)
+
+
+class KNNGraph:
+    '''Sparse k-nearest-neighbor connectivity graph over the rows of X.
+
+    Used to constrain agglomerative clustering to merges between neighbors,
+    which brings tree building close to O(n * k).
+
+    n_neighbors -- number of neighbors of every row
+    approximate -- if True, take the neighbors found in the leaves of a forest
+        of random projection trees instead of running an exact search
+    n_trees -- number of random projection trees (approximate only)
+    leaf_size -- maximum rows per tree leaf (approximate only)
+    n_jobs -- number of CPU cores; the exact search runs over row chunks and
+        the approximate one builds its trees in parallel
+    random_state -- seed of the random projection trees
+    '''
+    def __init__(self, n_neighbors=10, approximate=False, n_trees=8, leaf_size=None,
+                 n_jobs=None, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.approximate = approximate
+        self.n_trees = n_trees
+        self.leaf_size = leaf_size
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def build(self, X):
+        '''Return the n x n CSR connectivity matrix of the rows of X.'''
+        n = X.shape[0]
+        k = min(self.n_neighbors, n - 1)
+        if not self.approximate:
+            return kneighbors_graph(X, k, mode='connectivity', include_self=False, n_jobs=self.n_jobs)
+
+        if issparse(X):
+            X = X.tocsr()
+        sq = _row_norms_squared(X)
+        leaf_size = self.leaf_size or max(4 * k, 32)
+        seeds = np.random.RandomState(self.random_state).randint(2**31 - 1, size=self.n_trees)
+        candidates = Parallel(n_jobs=self.n_jobs)(
+            delayed(_rp_tree_neighbors)(X, sq, k, leaf_size, seed) for seed in seeds)
+        rows, cols, dists = (np.concatenate(c) for c in zip(*candidates))
+
+        # Drop pairs found by several trees, then keep the k closest per row
+        order = np.lexsort((cols, rows))
+        rows, cols, dists = rows[order], cols[order], dists[order]
+        unique = np.ones(len(rows), dtype=bool)
+        unique[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, dists = rows[unique], cols[unique], dists[unique]
+        order = np.lexsort((dists, rows))
+        rows, cols = rows[order], cols[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < k
+        return csr_matrix((np.ones(keep.sum()), (rows[keep], cols[keep])), shape=(n, n))
+
+
+class AgglomerativeTreeBuilder(TreeBuilder):
+    '''sklearn's AgglomerativeClustering (ward linkage by default).
+
+    Needs O(n^2) memory and time, and densifies sparse input. Given a
+    connectivity constraint, only neighbors in that sparse graph are merged,
+    which is much cheaper on large pools.
+
+    connectivity -- None, a KNNGraph built over X, or a precomputed sparse
+    n x n connectivity matrix
+    '''
+    def __init__(self, linkage='ward', connectivity=None, **kwargs):
+        self.linkage = linkage
+        self.connectivity = connectivity
+        self.kwargs = kwargs
+
+    def build(self, X):
+        connectivity = self.connectivity
+        if isinstance(connectivity, KNNGraph):
+            connectivity = connectivity.build(X)
+        clustering = AgglomerativeClustering(linkage=self.linkage, connectivity=connectivity,
+                                             compute_full_tree=True, **self.kwargs)
+        # sklearn only accepts dense input, so densify a temporary copy
+        clustering.fit(_to_dense(X))
+        return clustering.children_
+
+
+class NNChainTreeBuilder(TreeBuilder):
+    '''Ward or average linkage with the nearest-neighbor-chain algorithm.
+
+    Clusters are represented by their size, centroid and mean squared norm
+    instead of a pairwise distance matrix, so memory is O(n * d) and time is
+    O(n^2 * d).
+
+    linkage -- 'ward' for ward linkage, or 'average' for average linkage over
+    squared euclidean distances (mean of ||x - y||^2 over x in A and y in B,
+    which is ||c_A - c_B||^2 + var_A + var_B).
+    '''
+    def __init__(self, linkage='ward'):
+        if linkage not in ('ward', 'average'):
+            raise ValueError('unsupported linkage {}'.format(linkage))
+        self.linkage = linkage
+
+    def _distances(self, a, alive, centroids, sizes, variances):
+        '''Return the linkage distances from cluster slot a to every slot.'''
+        diff = centroids - centroids[a]
+        d = np.einsum('ij,ij->i', diff, diff)
+        if self.linkage == 'ward':
+            d *= 2.0 * sizes * sizes[a] / (sizes + sizes[a])
+        else:
+            d += variances + variances[a]
+        d[~alive] = np.inf
+        d[a] = np.inf
+        return d
+
+    def build(self, X):
+        # The working arrays are local, so one builder can build several trees at once
+        n = X.shape[0]
+        centroids = _to_dense(X).astype(np.float64)
+        sizes = np.ones(n)
+        moments = _row_norms_squared(centroids)  # mean squared norm
+        variances = np.zeros(n)  # mean squared distance to the centroid
+        node_ids = np.arange(n)  # node id currently held by each slot
+        alive = np.ones(n, dtype=bool)
+        children = np.empty((max(n - 1, 0), 2), dtype=np.intp)
+
+        chain = []
+        for merge in range(n - 1):
+            while True:
+                if not chain:
+                    chain.append(np.flatnonzero(alive)[0])
+                a = chain[-1]
+                d = self._distances(a, alive, centroids, sizes, variances)
+                b = np.argmin(d)
+                # Prefer the previous chain element on ties so the chain terminates
+                if len(chain) > 1 and d[chain[-2]] <= d[b]:
+                    b = chain[-2]
+                if len(chain) > 1 and b == chain[-2]:
+                    break
+                chain.append(b)
+
+            # a and b are reciprocal nearest neighbors: merge b into slot a
+            chain.pop()
+            chain.pop()
+            children[merge] = node_ids[a], node_ids[b]
+            size = sizes[a] + sizes[b]
+            centroids[a] = (sizes[a] * centroids[a] + sizes[b] * centroids[b]) / size
+            moments[a] = (sizes[a] * moments[a] + sizes[b] * moments[b]) / size
+            sizes[a] = size
+            variances[a] = moments[a] - np.dot(centroids[a], centroids[a])
+            node_ids[a] = n + merge
+            alive[b] = False
+
+        return children
+
+
+class MSTTreeBuilder(TreeBuilder):
+    '''Single linkage through a minimum spanning tree.
+
+    The MST is grown with Prim's algorithm, computing the distances of one
+    row to all others per step, so memory is O(n) on top of X and sparse X is
+    used as is. Sorting the MST edges and merging them with a union-find
+    gives the single linkage hierarchy.
+    '''
+    def build(self, X):
+        n = X.shape[0]
+        sq = _row_norms_squared(X)
+        in_tree = np.zeros(n, dtype=bool)
+        best = np.full(n, np.inf)  # squared distance of every row to the tree
+        nearest = np.zeros(n, dtype=np.intp)
+        edges = np.empty((max(n - 1, 0), 2), dtype=np.intp)
+        weights = np.empty(max(n - 1, 0))
+
+        cur = 0
+        in_tree[cur] = True
+        for i in range(n - 1):
+            dots = (X @ X[cur].T).toarray().ravel() if issparse(X) else X @ X[cur]
+            d = sq + sq[cur] - 2.0 * dots
+            closer = ~in_tree & (d < best)
+            best[closer] = d[closer]
+            nearest[closer] = cur
+            cur = np.argmin(np.where(in_tree, np.inf, best))
+            edges[i] = nearest[cur], cur
+            weights[i] = best[cur]
+            in_tree[cur] = True
+
+        # Kruskal-style merging of the sorted MST edges
+        parent = np.arange(n)  # union-find forest over samples
+        node_of_root = np.arange(n)
+
+        def find(x):
+            root = x
+            while parent[root] != root:
+                root = parent[root]
+            while parent[x] != root:
+                parent[x], x = root, parent[x]
+            return root
+
+        children = np.empty_like(edges)
+        for merge, (u, v) in enumerate(edges[np.argsort(weights, kind='stable')]):
+            ru, rv = find(u), find(v)
+            children[merge] = node_of_root[ru], node_of_root[rv]
+            parent[rv] = ru
+            node_of_root[ru] = n + merge
+        return children
+
+
+class BisectingKMeansTreeBuilder(TreeBuilder):
+    '''Top-down hierarchy that recursively splits clusters with 2-means.
+
+    Each level of the tree costs O(nnz(X)) per 2-means iteration, so a
+    balanced tree is built in roughly O(n log n). Sparse X is used as is.
+
+    n_iter -- maximum number of Lloyd iterations per split
+    random_state -- seed of the 2-means initializations
+    '''
+    def __init__(self, n_iter=10, random_state=None):
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def _split(self, X, sq, idx, rng):
+        '''Split the rows idx of X in two with 2-means.'''
+        m = len(idx)
+        if m == 2:
+            return idx[:1], idx[1:]
+        sub = X[idx]
+        centers = _to_dense(sub[rng.choice(m, 2, replace=False)]).astype(np.float64)
+        assign = None
+        for _ in range(self.n_iter):
+            d = sq[idx][:, None] - 2.0 * np.asarray(sub @ centers.T) + np.einsum('ij,ij->i', centers, centers)
+            new_assign = d[:, 1] < d[:, 0]
+            if assign is not None and np.array_equal(assign, new_assign):
+                break
+            assign = new_assign
+            if assign.all() or not assign.any():
+                break
+            centers[0] = np.asarray(sub[~assign].mean(axis=0)).ravel()
+            centers[1] = np.asarray(sub[assign].mean(axis=0)).ravel()
+        # Duplicate points cannot be separated, split them arbitrarily
+        if assign.all() or not assign.any():
+            assign = np.arange(m) >= m // 2
+        return idx[~assign], idx[assign]
+
+    def build(self, X):
+        n = X.shape[0]
+        rng = np.random.RandomState(self.random_state)
+        if issparse(X):
+            X = X.tocsr()
+        sq = _row_norms_squared(X)
+        children = np.empty((max(n - 1, 0), 2), dtype=np.intp)
+        num_merges = 0
+
+        # Post-order traversal with an explicit stack: a split pushes a merge
+        # marker below its two halves, and finished subtrees leave their node
+        # id on the results stack.
+        stack = [np.arange(n)]
+        results = []
+        while stack:
+            idx = stack.pop()
+            if idx is None:
+                right_id, left_id = results.pop(), results.pop()
+                children[num_merges] = left_id, right_id
+                results.append(n + num_merges)
+                num_merges += 1
+            elif len(idx) == 1:
+                results.append(idx[0])
+            else:
+                left, right = self._split(X, sq, idx, rng)
+                stack.extend([None, right, left])
+        return children
+
+
+def _build_shard(builder, X):
+    '''Run one shard of ShardedTreeBuilder (a module-level function so it pickles).'''
+    # A single-point shard (e.g. an outlier) is its own root, with no merges
+    if X.shape[0] < 2:
+        return np.zeros((0, 2), dtype=np.intp)
+    return builder.build(X)
+
+
+class ShardedTreeBuilder(TreeBuilder):
+    '''Divide-and-merge hierarchy built in parallel worker processes.
+
+    The rows of X are split into shards with k-means, a subtree is built over
+    every shard by its own worker, and a merge tree over the shard centroids
+    joins the shard roots into a single hierarchy.
+
+    n_shards -- number of shards, e.g. one per core
+    shard_builder -- TreeBuilder (or name in TREE_BUILDERS) run on every shard
+    merge_builder -- TreeBuilder (or name in TREE_BUILDERS) run on the shard centroids
+    executor -- concurrent.futures.Executor the shards are submitted to. Anything
+    with the same map() works, e.g. an executor that spreads work over several
+    nodes. Defaults to a ProcessPoolExecutor with n_jobs local processes.
+    n_jobs -- number of worker processes of the default executor (None for all cores)
+    random_state -- seed of the k-means sharding
+    '''
+    def __init__(self, n_shards=12, shard_builder=None, merge_builder=None, executor=None,
+                 n_jobs=None, random_state=None):
+        self.n_shards = n_shards
+        self.shard_builder = shard_builder
+        self.merge_builder = merge_builder
+        self.executor = executor
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def build(self, X):
+        n = X.shape[0]
+        if issparse(X):
+            X = X.tocsr()
+        n_shards = min(self.n_shards, n)
+        if n_shards <= 1:
+            return make_tree_builder(self.shard_builder).build(X)
+        labels = MiniBatchKMeans(n_shards, random_state=self.random_state, n_init=3).fit_predict(X)
+        labels = np.unique(labels, return_inverse=True)[1]
+        shards = np.split(np.argsort(labels, kind='stable'), np.cumsum(np.bincount(labels))[:-1])
+
+        shard_builder = make_tree_builder(self.shard_builder)
+        builders = [shard_builder] * len(shards)
+        if self.executor is not None:
+            subtrees = list(self.executor.map(_build_shard, builders, [X[idx] for idx in shards]))
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                subtrees = list(executor.map(_build_shard, builders, [X[idx] for idx in shards]))
+        top = make_tree_builder(self.merge_builder).build(cluster_means(X, labels))
+
+        # Renumber every subtree into the global layout: shard merges first,
+        # then the merges of the top tree, whose leaves are the shard roots.
+        children = np.empty((n - 1, 2), dtype=np.intp)
+        num_merges = 0
+        roots = []
+        for idx, subtree in zip(shards, subtrees):
+            m = len(idx)
+            global_ids = np.concatenate((idx, n + num_merges + np.arange(m - 1)))
+            children[num_merges:num_merges + m - 1] = global_ids[np.asarray(subtree, dtype=np.intp).reshape(-1, 2)]
+            num_merges += m - 1
+            roots.append(global_ids[-1])
+        global_ids = np.concatenate((roots, n + num_merges + np.arange(len(shards) - 1)))
+        children[num_merges:] = global_ids[np.asarray(top, dtype=np.intp).reshape(-1, 2)]
+        return children
+
+
+class Projection:
+    '''Low-dimensional float32 copy of X, used only to build the tree.
+
+    method -- 'svd' for TruncatedSVD, 'random' for a sparse random projection,
+    or 'hash' to hash the columns of X into n_components signed buckets
+    n_components -- number of output dimensions
+    random_state -- seed of the svd and random projections
+
+    The fitted projection is kept in projector_, so that rows added later
+    can be projected the same way with transform().
+    '''
+    def __init__(self, method='svd', n_components=100, random_state=None):
+        if method not in ('svd', 'random', 'hash'):
+            raise ValueError('unknown projection {}'.format(method))
+        self.method = method
+        self.n_components = n_components
+        self.random_state = random_state
+
+    def fit_transform(self, X):
+        '''Fit the projection to X and return the n x n_components float32 projection of its rows.'''
+        n_features = X.shape[1]
+        if n_features <= self.n_components:
+            self.projector_ = None
+            return _to_dense(X).astype(np.float32)
+        if self.method == 'svd':
+            self.projector_ = TruncatedSVD(self.n_components, random_state=self.random_state)
+            return _to_dense(self.projector_.fit_transform(X)).astype(np.float32)
+        if self.method == 'random':
+            self.projector_ = SparseRandomProjection(self.n_components, dense_output=True,
+                                                     random_state=self.random_state).fit(X)
+        else:
+            columns = np.arange(n_features, dtype=np.int32)
+            hashes = murmurhash3_32(columns, positive=False)
+            signs = np.where(hashes >= 0, 1.0, -1.0)
+            buckets = np.abs(hashes.astype(np.int64)) % self.n_components
+            self.projector_ = csr_matrix((signs, (columns, buckets)), shape=(n_features, self.n_components))
+        return self.transform(X)
+
+    def transform(self, X):
+        '''Return the float32 projection of the rows of X. fit_transform must have been called first.'''
+        if not hasattr(self, 'projector_'):
+            raise ValueError('the projection has not been fitted, call fit_transform first')
+        if self.projector_ is None:
+            reduced = X
+        elif issparse(self.projector_):
+            reduced = X @ self.projector_
+        else:
+            reduced = self.projector_.transform(X)
+        return _to_dense(reduced).astype(np.float32)
+
+
+class MicroClustering:
+    '''Groups the rows of X into micro-clusters that become the tree leaves.
+
+    method -- 'kmeans' for MiniBatchKMeans or 'birch' for Birch
+    n_clusters -- number of micro-clusters
+    random_state -- seed of the k-means initialization
+    '''
+    def __init__(self, n_clusters=1000, method='kmeans', random_state=None):
+        if method not in ('kmeans', 'birch'):
+            raise ValueError('unknown micro-clustering {}'.format(method))
+        self.n_clusters = n_clusters
+        self.method = method
+        self.random_state = random_state
+
+    def fit_predict(self, X):
+        '''Return the micro-cluster of every row of X, numbered 0..m-1 without gaps.'''
+        n = X.shape[0]
+        if self.n_clusters >= n:
+            return np.arange(n)
+        if self.method == 'kmeans':
+            clustering = MiniBatchKMeans(self.n_clusters, random_state=self.random_state, n_init=3)
+        else:
+            clustering = Birch(n_clusters=self.n_clusters)
+        labels = clustering.fit_predict(X)
+        # Drop the ids of micro-clusters that ended up empty
+        return np.unique(labels, return_inverse=True)[1]
+
+
+def cluster_means(X, labels):
+    '''Return the mean row of every cluster in labels (sparse if X is sparse).'''
+    counts = np.bincount(labels)
+    indicator = csr_matrix((1.0 / counts[labels], (labels, np.arange(X.shape[0]))),
+                           shape=(len(counts), X.shape[0]))
+    return indicator @ X
+
+
+TREE_BUILDERS = {
+    'agglomerative': AgglomerativeTreeBuilder,
+    'ward': lambda: NNChainTreeBuilder('ward'),
+    'average': lambda: NNChainTreeBuilder('average'),
+    'single': MSTTreeBuilder,
+    'bisecting': BisectingKMeansTreeBuilder,
+    'sharded': ShardedTreeBuilder,
+}
+
+
+def make_tree_builder(tree_builder):
+    '''Return a TreeBuilder from an engine name in TREE_BUILDERS or an engine.'''
+    if tree_builder is None:
+        return AgglomerativeTreeBuilder()
+    if isinstance(tree_builder, str):
+        if tree_builder not in TREE_BUILDERS:
+            raise ValueError('unknown tree builder {}'.format(tree_builder))
+        return TREE_BUILDERS[tree_builder]()
+    return tree_builder
+
+
+def make_micro_clustering(micro_clusters):
+    '''Return a MicroClustering from a number of micro-clusters or a MicroClustering.'''
+    if isinstance(micro_clusters, (int, np.integer)):
+        return MicroClustering(micro_clusters)
+    return micro_clusters
+
+
+def make_projection(projection):
+    '''Return a Projection from a method name or a Projection, or None.'''
+    if isinstance(projection, str):
+        return Projection(projection)
+    return projection